@@ -20,6 +20,7 @@ MouseArea {
         const totalImageMargin = (Appearance.sizes.wallpaperSelectorItemMargins + Appearance.sizes.wallpaperSelectorItemPadding) * 2;
         const thumbnailSizeName = Images.thumbnailSizeNameForDimensions(grid.cellWidth - totalImageMargin, grid.cellHeight - totalImageMargin);
         Wallpapers.generateThumbnail(thumbnailSizeName);
+        grid.prioritizeVisibleThumbnails();
     }
 
     Connections {
@@ -297,6 +298,24 @@ MouseArea {
                             root.updateThumbnails();
                         }
 
+                        onContentYChanged: prioritizeTimer.restart()
+                        onCountChanged: prioritizeTimer.restart()
+                        Timer {
+                            id: prioritizeTimer
+                            interval: 100
+                            onTriggered: grid.prioritizeVisibleThumbnails()
+                        }
+                        function prioritizeVisibleThumbnails() { // Visible rows and one extra row on each side
+                            const firstRow = Math.max(0, Math.floor(contentY / cellHeight) - 1);
+                            const lastRow = Math.ceil((contentY + height) / cellHeight) + 1;
+                            const paths = [];
+                            for (let i = firstRow * columns; i < Math.min(count, lastRow * columns); i++) {
+                                const filePath = model.get(i, "filePath");
+                                if (filePath) paths.push(filePath);
+                            }
+                            Wallpapers.prioritizeThumbnails(paths);
+                        }
+
                         function moveSelection(delta) {
                             currentIndex = Math.max(0, Math.min(grid.model.count - 1, currentIndex + delta));
                             positionViewAtIndex(currentIndex, GridView.Contain);
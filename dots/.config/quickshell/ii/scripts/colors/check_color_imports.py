@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+Import check for the --color path of generate_colors_material.py, the one accent color
+picking waits on. Runs it the way switchwall.sh does under python -X importtime and
+fails if anything only images (or the server, or --batch) need gets imported, or, with
+--budget_ms, if importing takes longer than that.
+
+Run it with the Python generate_colors_material.py uses, e.g.
+    source ../lib/venv.sh && run_in_venv python3 check_color_imports.py --budget_ms 150
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+GENERATOR = os.path.join(SCRIPT_DIR, "generate_colors_material.py")
+TERMSCHEME = os.path.join(SCRIPT_DIR, "terminal", "scheme-base.json")
+# Top level modules, or packages and everything in them
+FORBIDDEN = [
+    "PIL",
+    "numpy",
+    "cv2",
+    "materialyoucolor.quantize",
+    "materialyoucolor.score",
+    "hct_numpy",
+    "scheme_for_image",
+    "socket",
+    "multiprocessing",
+]
+
+
+def imported_modules(command):
+    """(module, cumulative microseconds, nesting depth) for everything the command imports."""
+    result = subprocess.run([sys.executable, "-X", "importtime"] + command, capture_output=True, text=True)
+    if result.returncode != 0:
+        sys.exit("generate_colors_material.py failed:\n" + result.stderr)
+    modules = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        modules.append((name.strip(), int(cumulative), (len(name) - len(name.lstrip())) // 2))
+    return modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check what the --color path of generate_colors_material.py imports")
+    parser.add_argument("--color", default="#6750a4")
+    parser.add_argument("--budget_ms", type=float, default=None, help="also fail if all imports together take longer")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="check-color-imports-") as out_dir:
+        # Like switchwall.sh, minus the terminals, which would get the colors sent to them
+        command = [GENERATOR, "--color", args.color, "--mode", "dark", "--scheme", "scheme-tonal-spot",
+                   "--termscheme", TERMSCHEME, "--blend_bg_fg", "--cache", os.path.join(out_dir, "color.txt"),
+                   "--render", out_dir, "--no_terminal"]
+        modules = imported_modules(command)
+
+    forbidden = [name for name, _, _ in modules if any(name == f or name.startswith(f + ".") for f in FORBIDDEN)]
+    # Top level imports include everything under them
+    total_ms = sum(cumulative for _, cumulative, depth in modules if depth == 1) / 1000
+    print(f"{len(modules)} modules imported in {total_ms:.1f} ms")
+    failed = False
+    if forbidden:
+        print("Imported on the --color path: " + ", ".join(forbidden), file=sys.stderr)
+        failed = True
+    if args.budget_ms is not None and total_ms > args.budget_ms:
+        print(f"Imports took {total_ms:.1f} ms, over the {args.budget_ms:g} ms budget", file=sys.stderr)
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
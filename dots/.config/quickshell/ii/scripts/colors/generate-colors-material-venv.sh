@@ -0,0 +1,6 @@
+#!/usr/bin/env bash
+SCRIPT_DIR="$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)"
+
+source "$SCRIPT_DIR/../lib/venv.sh"
+run_in_venv python3 "$SCRIPT_DIR/generate_colors_material.py" "$@"
+exit $?
@@ -1,15 +1,31 @@
 #!/usr/bin/env -S\_/bin/sh\_-c\_"source\_\$(eval\_echo\_\$ILLOGICAL_IMPULSE_VIRTUAL_ENV)/bin/activate&&exec\_python\_-E\_"\$0"\_"\$@""
+# Only what every run needs is imported here: --color (accent color picking) never
+# touches an image, so PIL and the quantizer are imported where they're used
 import argparse
+import contextlib
+import functools
+import io
 import math
 import json
-from PIL import Image
-from materialyoucolor.quantize import QuantizeCelebi
-from materialyoucolor.score.score import Score
+import os
+import re
+import signal
+import sys
 from materialyoucolor.hct import Hct
 from materialyoucolor.dynamiccolor.material_dynamic_colors import MaterialDynamicColors
 from materialyoucolor.utils.color_utils import (rgba_from_argb, argb_from_rgb, argb_from_rgba)
 from materialyoucolor.utils.math_utils import (sanitize_degrees_double, difference_degrees, rotation_direction)
 
+def screen_size (text: str) -> tuple:
+    width, _, height = text.partition('x')
+    try:
+        size = int(width), int(height)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected WIDTHxHEIGHT, got '{text}'")
+    if min(size) <= 0:
+        raise argparse.ArgumentTypeError(f"expected a positive size, got '{text}'")
+    return size
+
 parser = argparse.ArgumentParser(description='Color generation script')
 parser.add_argument('--path', type=str, default=None, help='generate colorscheme from image')
 parser.add_argument('--size', type=int , default=128 , help='bitmap image size')
@@ -25,7 +41,19 @@ parser.add_argument('--term_fg_boost', type=float , default=0.35, help='Make ter
 parser.add_argument('--blend_bg_fg', action='store_true', default=False, help='Shift terminal background or foreground towards accent')
 parser.add_argument('--cache', type=str, default=None, help='file path to store the generated color')
 parser.add_argument('--debug', action='store_true', default=False, help='debug mode')
-args = parser.parse_args()
+parser.add_argument('--no_palette_cache', action='store_true', default=False, help='always quantize the image, even if it was done before')
+parser.add_argument('--render', type=str, default=None, metavar='DIR', help='also write material_colors.scss, material_colors.json and the terminal themes to DIR, only files whose content changed')
+parser.add_argument('--no_terminal', action='store_true', default=False, help='with --render, leave the terminal themes alone')
+parser.add_argument('--term_alpha', type=int, default=89, help='terminal background opacity (0-100) for templates that use $alpha')
+parser.add_argument('--variants', type=str, default=None, metavar='SCHEMES', help='also compute these schemes (comma separated, or all) in every --variant_modes mode from the same analysis, into one JSON bundle')
+parser.add_argument('--variant_modes', type=str, default='dark,light', help='modes for --variants, comma separated')
+parser.add_argument('--variants_output', type=str, default=None, help='file for the --variants bundle, default: color_variants.json in the --render directory, or stdout instead of the scss')
+parser.add_argument('--batch', type=str, default=None, metavar='DIR', help='index the palette and preview colors of every image in DIR (- reads paths from stdin) instead of generating a scheme, --scheme auto picks one per image like switchwall.sh')
+parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='processes for --batch')
+parser.add_argument('--index', type=str, default=None, help='index file for --batch, default: ~/.cache/quickshell/palette-index.json')
+parser.add_argument('--analyze', type=str, default=None, metavar='FILE', help='with --path, write the wallpaper analysis (seed, colorfulness and auto scheme, dominant colors, variance map) as JSON to FILE (- for stdout) instead of generating a scheme')
+parser.add_argument('--screen', type=screen_size, default=None, metavar='WxH', help='screen the wallpaper covers, for the --analyze variance map')
+parser.add_argument('--serve', type=str, default=None, metavar='SOCKET', help='stay resident and answer requests from generate_colors_material_client.py on this Unix socket')
 
 rgba_to_hex = lambda rgba: "#{:02X}{:02X}{:02X}".format(rgba[0], rgba[1], rgba[2])
 argb_to_hex = lambda argb: "#{:02X}{:02X}{:02X}".format(*map(round, rgba_from_argb(argb)))
@@ -58,124 +86,761 @@ def boost_chroma_tone (argb: int, chroma: float = 1, tone: float = 1) -> int:
     hct = Hct.from_int(argb)
     return Hct.from_hct(hct.hue, hct.chroma * chroma, hct.tone * tone).to_int()
 
-darkmode = (args.mode == 'dark')
-transparent = (args.transparency == 'transparent')
+XDG_CACHE_HOME = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+PALETTE_CACHE_DIR = os.path.join(XDG_CACHE_HOME, 'quickshell', 'palette-cache')
+PALETTE_CACHE_MAX_ENTRIES = 256
+# Bump when what gets cached (or how it's computed) changes
+PALETTE_CACHE_VERSION = 3
+QUANTIZE_MAX_COLORS = 128
+# Smallest first, see https://specifications.freedesktop.org/thumbnail-spec/latest/directory.html
+THUMBNAIL_SIZES = ['normal', 'large', 'x-large', 'xx-large']
+# Characters g_filename_to_uri() leaves alone, as in thumbgen.py
+URI_SAFE_CHARS = "/!$&'()*+,:=@~"
+ANALYSIS_VERSION = 1
+# Variance map cells along the long edge, and gray pixels per cell side they're computed from
+VARIANCE_MAP_CELLS = 64
+VARIANCE_MAP_CELL_PIXELS = 4
+DOMINANT_COLORS = 5
+# scheme_for_image.py's max_dim
+COLORFULNESS_MAX_DIM = 128
+PALETTE_INDEX_PATH = os.path.join(XDG_CACHE_HOME, 'quickshell', 'palette-index.json')
+PALETTE_INDEX_VERSION = 1
+# What Wallpapers.qml lists, minus svg which PIL can't open
+BATCH_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.avif', '.bmp')
+# Enough for a preview, a real switch still computes every role
+PREVIEW_ROLES = ['primary', 'onPrimary', 'primaryContainer', 'onPrimaryContainer', 'secondary', 'secondaryContainer',
+                 'tertiary', 'tertiaryContainer', 'background', 'onBackground', 'surface', 'surfaceContainer',
+                 'surfaceContainerHigh', 'onSurface', 'onSurfaceVariant', 'outline']
+# For reading a request and writing the response, a client that stalls longer is dropped
+SERVE_IO_TIMEOUT_SECONDS = 5
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+TERMINAL_TEMPLATES = {
+    'kitty-theme.conf': os.path.join(SCRIPT_DIR, 'terminal', 'kitty-theme.conf'),
+    'sequences.txt': os.path.join(SCRIPT_DIR, 'terminal', 'sequences.txt'),
+}
+# "$name #" is a color without its #, as applycolor.sh used to substitute them
+TEMPLATE_PLACEHOLDER = re.compile(r'\$(\w+) #|\$alpha')
+
+def palette_cache_key (path: str, bitmap_size: int, route: str) -> str:
+    import hashlib
+    st = os.stat(path)
+    # The route too: a thumbnail gives slightly different colors than the original
+    key = f"{PALETTE_CACHE_VERSION}\0{os.path.realpath(path)}\0{st.st_size}\0{st.st_mtime_ns}\0{bitmap_size}\0{QUANTIZE_MAX_COLORS}\0{route}"
+    return hashlib.sha256(key.encode(errors='surrogateescape')).hexdigest()
+
+def load_cached_palette (key: str):
+    entry_path = os.path.join(PALETTE_CACHE_DIR, key + '.json')
+    try:
+        with open(entry_path) as f:
+            palette = json.load(f)
+    except (OSError, ValueError):
+        return None
+    # The mtime is the last use, for eviction
+    with contextlib.suppress(OSError):
+        os.utime(entry_path)
+    return palette
+
+def store_palette (key: str, palette: dict):
+    """Atomic, so other processes only ever see complete entries, then trims the cache to size."""
+    os.makedirs(PALETTE_CACHE_DIR, exist_ok=True)
+    entry_path = os.path.join(PALETTE_CACHE_DIR, key + '.json')
+    temp_path = f"{entry_path}.{os.getpid()}.tmp"
+    try:
+        with open(temp_path, 'w') as f:
+            json.dump(palette, f)
+        os.replace(temp_path, entry_path)
+    finally:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(temp_path)
 
-if args.path is not None:
-    image = Image.open(args.path)
+    entries = []
+    for entry in os.scandir(PALETTE_CACHE_DIR):
+        if entry.name.endswith('.json'):
+            with contextlib.suppress(FileNotFoundError):
+                entries.append((entry.stat().st_mtime, entry.path))
+    entries.sort()
+    for _, old_entry_path in entries[:max(0, len(entries) - PALETTE_CACHE_MAX_ENTRIES)]:
+        # Someone else may be evicting too
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(old_entry_path)
+
+def fresh_thumbnail (path: str, width: int, height: int):
+    """The smallest freedesktop thumbnail of path that's up to date and at least width x height
+    (either way round), opened, and its size name. None if there is no such thumbnail."""
+    import hashlib
+    import urllib.parse
+    from PIL import Image
+    uri = 'file://' + urllib.parse.quote_from_bytes(os.fsencode(os.path.abspath(path)), safe=URI_SAFE_CHARS)
+    name = hashlib.md5(uri.encode()).hexdigest() + '.png'
+    mtime = str(int(os.path.getmtime(path)))
+    for size in THUMBNAIL_SIZES:
+        try:
+            thumbnail = Image.open(os.path.join(XDG_CACHE_HOME, 'thumbnails', size, name))
+        except (OSError, SyntaxError, ValueError):
+            continue
+        # Thumbnails follow the EXIF orientation, the original's header doesn't
+        big_enough = all(have >= need for have, need in zip(sorted(thumbnail.size), sorted((width, height))))
+        # info only has the text chunks in front of the image data, which is where thumbnails
+        # keep theirs, unlike text it doesn't decode the whole thing to look for more
+        if big_enough and thumbnail.info.get('Thumb::URI') == uri and thumbnail.info.get('Thumb::MTime') == mtime:
+            return thumbnail, size
+        thumbnail.close()
+    return None
+
+def open_reduced (path: str, needed) -> tuple:
+    """
+    Picks the cheapest way to decode the image at least needed(width, height) big (the
+    original size in, the minimum size out), only reading headers: a fresh freedesktop
+    thumbnail if one is big enough, otherwise JPEGs at 1/2, 1/4 or 1/8 scale right in the
+    decoder. Returns what decode_reduced() takes.
+    """
+    from PIL import Image
+    image = Image.open(path)
+    wsize, hsize = image.size
+    wsize_new, hsize_new = needed(wsize, hsize)
+    route = 'full'
 
     if image.format == "GIF":
         image.seek(1)
+    elif wsize_new < wsize or hsize_new < hsize:
+        found = fresh_thumbnail(path, wsize_new, hsize_new)
+        if found is not None:
+            image.close()
+            image, size = found
+            route = f"thumbnail:{size}"
+            if (image.width < image.height) != (wsize_new < hsize_new):
+                wsize_new, hsize_new = hsize_new, wsize_new
+        elif image.format == "JPEG":
+            image.draft('RGB', (wsize_new, hsize_new))
+            if image.width < wsize:
+                route = f"draft:1/{wsize // image.width}"
+    return image, (wsize, hsize), (wsize_new, hsize_new), route
 
+def decode_reduced (path: str, needed, opened: tuple = None):
+    """
+    Decodes the image the way open_reduced() picks, or already picked, and shrinks it
+    with Image.reduce() to within 2x of the minimum size. Returns the image, the original
+    size and the route taken.
+    """
+    image, (wsize, hsize), (wsize_new, hsize_new), route = opened or open_reduced(path, needed)
     if image.mode in ["L", "P"]:
         image = image.convert('RGB')
-    wsize, hsize = image.size
-    wsize_new, hsize_new = calculate_optimal_size(wsize, hsize, args.size)
-    if wsize_new < wsize or hsize_new < hsize:
+    factor = min(image.width // wsize_new, image.height // hsize_new) // 2
+    if factor > 1:
+        image = image.reduce(factor)
+        route = f"reduce:1/{factor}" if route == 'full' else f"{route}+reduce:1/{factor}"
+    return image, (wsize, hsize), route
+
+def palette_bitmap (image, original_size: tuple, bitmap_size: int):
+    """The decoded image resized to what gets quantized, about bitmap_size squared."""
+    from PIL import Image
+    wsize_new, hsize_new = calculate_optimal_size(*original_size, bitmap_size)
+    # A thumbnail can be the other way round, it follows the EXIF orientation
+    if (image.width < image.height) != (wsize_new < hsize_new):
+        wsize_new, hsize_new = hsize_new, wsize_new
+    if wsize_new < image.width or hsize_new < image.height:
         image = image.resize((wsize_new, hsize_new), Image.Resampling.BICUBIC)
-    colors = QuantizeCelebi(list(image.getdata()), 128)
-    argb = Score.score(colors)[0]
+    return image
 
-    if args.cache is not None:
-        with open(args.cache, 'w') as file:
-            file.write(argb_to_hex(argb))
-    hct = Hct.from_int(argb)
-    if(args.smart):
-        if(hct.chroma < 20):
-            args.scheme = 'neutral'
-elif args.color is not None:
-    argb = hex_to_argb(args.color)
-    hct = Hct.from_int(argb)
+def palette_of (bitmap, original_size: tuple, route: str) -> dict:
+    from materialyoucolor.quantize import QuantizeCelebi
+    from materialyoucolor.score.score import Score
+    colors = QuantizeCelebi(list(bitmap.getdata()), QUANTIZE_MAX_COLORS)
+    return {
+        'image_size': list(original_size),
+        'resized_size': list(bitmap.size),
+        'decoded_from': route,
+        'colors': [[argb, count] for argb, count in colors.items()],
+        'ranked': Score.score(colors),
+    }
+
+def image_palette (path: str, bitmap_size: int, opened: tuple = None) -> dict:
+    """Quantized colors of the image and their ranking, the expensive part of an image based scheme."""
+    image, original_size, route = decode_reduced(path, lambda width, height: calculate_optimal_size(width, height, bitmap_size), opened)
+    return palette_of(palette_bitmap(image, original_size, bitmap_size), original_size, route)
+
+def cached_image_palette (path: str, bitmap_size: int, use_cache: bool = True) -> dict:
+    # Keyed by path, size, mtime and route: switching back to a wallpaper or toggling
+    # dark/light only redoes the scheme and terminal colors
+    opened = open_reduced(path, lambda width, height: calculate_optimal_size(width, height, bitmap_size))
+    key = palette_cache_key(path, bitmap_size, opened[-1]) if use_cache else None
+    palette = load_cached_palette(key) if key is not None else None
+    if palette is None:
+        palette = image_palette(path, bitmap_size, opened)
+        if key is not None:
+            store_palette(key, palette)
+    else:
+        opened[0].close()
+    return palette
+
+def colorfulness_size (width: int, height: int) -> tuple:
+    # Same size as scheme_for_image.load_and_resize_image
+    scale = min(1, COLORFULNESS_MAX_DIM / max(width, height))
+    return max(1, int(width * scale)), max(1, int(height * scale))
+
+def colorfulness_bitmap (image, original_size: tuple):
+    """The decoded image at the size scheme_for_image.py measures colorfulness at, box filtered like its INTER_AREA."""
+    from PIL import Image
+    width, height = colorfulness_size(*original_size)
+    if (image.width < image.height) != (width < height):
+        width, height = height, width
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    return image.resize((width, height), Image.Resampling.BOX)
+
+def colorfulness_of (bitmap) -> float:
+    import numpy as np
+    import scheme_for_image
+    # It takes BGR, like cv2.imread gives
+    return float(scheme_for_image.image_colorfulness(np.ascontiguousarray(np.asarray(bitmap)[:, :, ::-1])))
+
+def analyze_wallpaper (path: str, bitmap_size: int, screen: tuple = None, use_cache: bool = True) -> dict:
+    """
+    Everything a wallpaper switch wants to know about the image: the seed colors, the
+    colorfulness and the scheme switchwall.sh's auto type picks from it, the colors most of
+    the image is made of, and a coarse variance map of the part of it that covers the screen
+    (scaled to cover and center cropped, like least_busy_region.py). The palette goes through
+    the palette cache, so generating the scheme afterwards doesn't decode the image again.
+    """
+    import numpy as np
+    from PIL import Image
+    import scheme_for_image
+
+    def screen_crop (width: int, height: int) -> tuple:
+        # (left, top, right, bottom) in image pixels
+        if screen is None:
+            return 0, 0, width, height
+        crop_width, crop_height = min(width, height * screen[0] / screen[1]), min(height, width * screen[1] / screen[0])
+        left, top = (width - crop_width) / 2, (height - crop_height) / 2
+        return left, top, left + crop_width, top + crop_height
+
+    def map_grid (width: int, height: int) -> tuple:
+        left, top, right, bottom = screen_crop(width, height)
+        long_edge = max(right - left, bottom - top)
+        return (max(1, round(VARIANCE_MAP_CELLS * (right - left) / long_edge)),
+                max(1, round(VARIANCE_MAP_CELLS * (bottom - top) / long_edge)))
+
+    def needed (width: int, height: int) -> tuple:
+        left, top, right, bottom = screen_crop(width, height)
+        columns, rows = map_grid(width, height)
+        # The crop has to come out at least VARIANCE_MAP_CELL_PIXELS per cell
+        scale = max(columns * VARIANCE_MAP_CELL_PIXELS / (right - left), rows * VARIANCE_MAP_CELL_PIXELS / (bottom - top))
+        return min(width, math.ceil(width * scale)), min(height, math.ceil(height * scale))
+
+    image, (wsize, hsize), route = decode_reduced(path, needed)
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    if (image.width < image.height) != (wsize < hsize):
+        # A thumbnail the other way round, everything below is in the original's orientation
+        image = image.transpose(Image.Transpose.ROTATE_90)
+
+    # Its own decode at palette size, so the seed is the one a --path run gets, cached or not
+    palette = cached_image_palette(path, bitmap_size, use_cache)
+
+    small = colorfulness_bitmap(image, (wsize, hsize))
+    colorfulness = colorfulness_of(small)
+
+    columns, rows = map_grid(wsize, hsize)
+    ratio = image.width / wsize
+    left, top, right, bottom = (edge * ratio for edge in screen_crop(wsize, hsize))
+    gray = image.convert('L').resize((columns * VARIANCE_MAP_CELL_PIXELS, rows * VARIANCE_MAP_CELL_PIXELS), Image.Resampling.BOX, box=(left, top, right, bottom))
+    cells = np.asarray(gray, dtype=np.float64).reshape(rows, VARIANCE_MAP_CELL_PIXELS, columns, VARIANCE_MAP_CELL_PIXELS)
+    map_width, map_height = screen if screen is not None else ((right - left) / ratio, (bottom - top) / ratio)
+
+    # The palette has up to 128 colors, too fine to say what the image is mostly made of
+    quantized = small.quantize(DOMINANT_COLORS, method=Image.Quantize.MEDIANCUT)
+    palette_rgb = quantized.getpalette()
+    dominant = sorted(quantized.getcolors(), reverse=True)
+    st = os.stat(path)
+    return {
+        'version': ANALYSIS_VERSION,
+        'path': os.path.abspath(path),
+        'file_size': st.st_size,
+        'mtime_ns': st.st_mtime_ns,
+        'image_size': [wsize, hsize],
+        'decoded_from': route,
+        'seed': argb_to_hex(palette['ranked'][0]),
+        'seeds': [argb_to_hex(argb) for argb in palette['ranked']],
+        'colorfulness': round(colorfulness, 2),
+        'scheme': scheme_for_image.pick_scheme(colorfulness),
+        'dominant_colors': [{'color': rgba_to_hex(palette_rgb[index * 3:index * 3 + 3]), 'fraction': round(count / (small.width * small.height), 4)}
+                            for count, index in dominant],
+        'variance_map': {
+            # Cells are in screen pixels with --screen, in image pixels otherwise
+            'screen': list(screen) if screen is not None else None,
+            'columns': columns,
+            'rows': rows,
+            'cell_width': round(map_width / columns, 3),
+            'cell_height': round(map_height / rows, 3),
+            'mean': np.round(cells.mean(axis=(1, 3)), 2).tolist(),
+            'variance': np.round(cells.var(axis=(1, 3)), 2).tolist(),
+        },
+    }
+
+def smart_scheme (scheme_name: str, hct) -> str:
+    """What --smart makes of the scheme for this seed color."""
+    if(hct.chroma < 20):
+        return 'neutral'
+    return scheme_name
+
+def material_colors_of (scheme, roles: list = None) -> dict:
+    """Hex colors of the MaterialDynamicColors roles in the scheme, all of them by default."""
+    material_colors = {}
+    for color in (vars(MaterialDynamicColors).keys() if roles is None else roles):
+        color_name = getattr(MaterialDynamicColors, color)
+        if hasattr(color_name, "get_hct"):
+            rgba = color_name.get_hct(scheme).to_rgba()
+            material_colors[color] = rgba_to_hex(rgba)
+    return material_colors
+
+def get_scheme_class (scheme_name: str):
+    if scheme_name == 'scheme-fruit-salad':
+        from materialyoucolor.scheme.scheme_fruit_salad import SchemeFruitSalad as Scheme
+    elif scheme_name == 'scheme-expressive':
+        from materialyoucolor.scheme.scheme_expressive import SchemeExpressive as Scheme
+    elif scheme_name == 'scheme-monochrome':
+        from materialyoucolor.scheme.scheme_monochrome import SchemeMonochrome as Scheme
+    elif scheme_name == 'scheme-rainbow':
+        from materialyoucolor.scheme.scheme_rainbow import SchemeRainbow as Scheme
+    elif scheme_name == 'scheme-tonal-spot':
+        from materialyoucolor.scheme.scheme_tonal_spot import SchemeTonalSpot as Scheme
+    elif scheme_name == 'scheme-neutral':
+        from materialyoucolor.scheme.scheme_neutral import SchemeNeutral as Scheme
+    elif scheme_name == 'scheme-fidelity':
+        from materialyoucolor.scheme.scheme_fidelity import SchemeFidelity as Scheme
+    elif scheme_name == 'scheme-content':
+        from materialyoucolor.scheme.scheme_content import SchemeContent as Scheme
+    elif scheme_name == 'scheme-vibrant':
+        from materialyoucolor.scheme.scheme_vibrant import SchemeVibrant as Scheme
+    else:
+        from materialyoucolor.scheme.scheme_tonal_spot import SchemeTonalSpot as Scheme
+    return Scheme
+
+def scheme_variant (hct, scheme_name: str, darkmode: bool, args, termscheme: dict = None):
+    """Material colors and harmonized terminal colors of one scheme and mode."""
+    Scheme = get_scheme_class(scheme_name)
+    # Generate
+    scheme = Scheme(hct, darkmode, 0.0)
+
+    material_colors = material_colors_of(scheme)
+    term_colors = {}
+
+    # Extended material
+    if darkmode == True:
+        material_colors['success'] = '#B5CCBA'
+        material_colors['onSuccess'] = '#213528'
+        material_colors['successContainer'] = '#374B3E'
+        material_colors['onSuccessContainer'] = '#D1E9D6'
+    else:
+        material_colors['success'] = '#4F6354'
+        material_colors['onSuccess'] = '#FFFFFF'
+        material_colors['successContainer'] = '#D1E8D5'
+        material_colors['onSuccessContainer'] = '#0C1F13'
 
-if args.scheme == 'scheme-fruit-salad':
-    from materialyoucolor.scheme.scheme_fruit_salad import SchemeFruitSalad as Scheme
-elif args.scheme == 'scheme-expressive':
-    from materialyoucolor.scheme.scheme_expressive import SchemeExpressive as Scheme
-elif args.scheme == 'scheme-monochrome':
-    from materialyoucolor.scheme.scheme_monochrome import SchemeMonochrome as Scheme
-elif args.scheme == 'scheme-rainbow':
-    from materialyoucolor.scheme.scheme_rainbow import SchemeRainbow as Scheme
-elif args.scheme == 'scheme-tonal-spot':
-    from materialyoucolor.scheme.scheme_tonal_spot import SchemeTonalSpot as Scheme
-elif args.scheme == 'scheme-neutral':
-    from materialyoucolor.scheme.scheme_neutral import SchemeNeutral as Scheme
-elif args.scheme == 'scheme-fidelity':
-    from materialyoucolor.scheme.scheme_fidelity import SchemeFidelity as Scheme
-elif args.scheme == 'scheme-content':
-    from materialyoucolor.scheme.scheme_content import SchemeContent as Scheme
-elif args.scheme == 'scheme-vibrant':
-    from materialyoucolor.scheme.scheme_vibrant import SchemeVibrant as Scheme
-else:
-    from materialyoucolor.scheme.scheme_tonal_spot import SchemeTonalSpot as Scheme
-# Generate
-scheme = Scheme(hct, darkmode, 0.0)
-
-material_colors = {}
-term_colors = {}
-
-for color in vars(MaterialDynamicColors).keys():
-    color_name = getattr(MaterialDynamicColors, color)
-    if hasattr(color_name, "get_hct"):
-        rgba = color_name.get_hct(scheme).to_rgba()
-        material_colors[color] = rgba_to_hex(rgba)
-
-# Extended material
-if darkmode == True:
-    material_colors['success'] = '#B5CCBA'
-    material_colors['onSuccess'] = '#213528'
-    material_colors['successContainer'] = '#374B3E'
-    material_colors['onSuccessContainer'] = '#D1E9D6'
-else:
-    material_colors['success'] = '#4F6354'
-    material_colors['onSuccess'] = '#FFFFFF'
-    material_colors['successContainer'] = '#D1E8D5'
-    material_colors['onSuccessContainer'] = '#0C1F13'
-
-# Terminal Colors
-if args.termscheme is not None:
-    with open(args.termscheme, 'r') as f:
-        json_termscheme = f.read()
-    term_source_colors = json.loads(json_termscheme)['dark' if darkmode else 'light']
-
-    primary_color_argb = hex_to_argb(material_colors['primary_paletteKeyColor'])
-    for color, val in term_source_colors.items():
-        if(args.scheme == 'monochrome') :
-            term_colors[color] = val
+    # Terminal Colors
+    if termscheme is not None:
+        term_source_colors = termscheme['dark' if darkmode else 'light']
+
+        primary_color_argb = hex_to_argb(material_colors['primary_paletteKeyColor'])
+        for color, val in term_source_colors.items():
+            if(scheme_name == 'monochrome') :
+                term_colors[color] = val
+                continue
+            if args.blend_bg_fg and color == "term0":
+                harmonized = boost_chroma_tone(hex_to_argb(material_colors['surfaceContainerLow']), 1.2, 0.95)
+            elif args.blend_bg_fg and color == "term15":
+                harmonized = boost_chroma_tone(hex_to_argb(material_colors['onSurface']), 3, 1)
+            else:
+                harmonized = harmonize(hex_to_argb(val), primary_color_argb, args.harmonize_threshold, args.harmony)
+                harmonized = boost_chroma_tone(harmonized, 1, 1 + (args.term_fg_boost * (1 if darkmode else -1)))
+            term_colors[color] = argb_to_hex(harmonized)
+    return material_colors, term_colors
+
+def batch_term_colors (variants: list, args, termscheme: dict) -> list:
+    """Terminal colors of many (material_colors, scheme_name, darkmode) variants, same as
+    scheme_variant's but with every HCT conversion done in one NumPy pass."""
+    import hct_numpy # Pulls in numpy, not worth it for a single variant
+    results = []
+    designs, sources = [], []
+    # Every terminal color ends with a boost, None stands for the next harmonized color
+    slots, boost_argbs, chroma_factors, tone_factors = [], [], [], []
+    for material_colors, scheme_name, darkmode in variants:
+        term_source_colors = termscheme['dark' if darkmode else 'light']
+        term_colors = {}
+        results.append(term_colors)
+        if scheme_name == 'monochrome':
+            term_colors.update(term_source_colors)
             continue
-        if args.blend_bg_fg and color == "term0":
-            harmonized = boost_chroma_tone(hex_to_argb(material_colors['surfaceContainerLow']), 1.2, 0.95)
-        elif args.blend_bg_fg and color == "term15":
-            harmonized = boost_chroma_tone(hex_to_argb(material_colors['onSurface']), 3, 1)
+        primary_color_argb = hex_to_argb(material_colors['primary_paletteKeyColor'])
+        for color, val in term_source_colors.items():
+            term_colors[color] = None # Keeps the order of the termscheme
+            slots.append((term_colors, color))
+            if args.blend_bg_fg and color == "term0":
+                boost_argbs.append(hex_to_argb(material_colors['surfaceContainerLow']))
+                chroma_factors.append(1.2)
+                tone_factors.append(0.95)
+            elif args.blend_bg_fg and color == "term15":
+                boost_argbs.append(hex_to_argb(material_colors['onSurface']))
+                chroma_factors.append(3)
+                tone_factors.append(1)
+            else:
+                boost_argbs.append(None)
+                designs.append(hex_to_argb(val))
+                sources.append(primary_color_argb)
+                chroma_factors.append(1)
+                tone_factors.append(1 + (args.term_fg_boost * (1 if darkmode else -1)))
+    if not slots:
+        return results
+    harmonized = iter(hct_numpy.harmonize(designs, sources, args.harmonize_threshold, args.harmony).tolist())
+    boost_argbs = [next(harmonized) if argb is None else argb for argb in boost_argbs]
+    boosted = hct_numpy.boost_chroma_tone(boost_argbs, chroma_factors, tone_factors)
+    for (term_colors, color), argb in zip(slots, boosted):
+        term_colors[color] = argb_to_hex(int(argb))
+    return results
+
+def variants_bundle (hct, args, termscheme: dict = None) -> dict:
+    """Every requested scheme and mode for one seed color, keyed "scheme/mode"."""
+    schemes = SCHEMES if args.variants == 'all' else [name for name in args.variants.split(',') if name]
+    modes = [mode for mode in args.variant_modes.split(',') if mode]
+    keys, material = [], []
+    for scheme_name in schemes:
+        for mode in modes:
+            material_colors, _ = scheme_variant(hct, scheme_name, mode == 'dark', args)
+            keys.append((scheme_name, mode))
+            material.append((material_colors, scheme_name, mode == 'dark'))
+    term = batch_term_colors(material, args, termscheme) if termscheme is not None else [{} for _ in material]
+    variants = {}
+    for (scheme_name, mode), (material_colors, _, _), term_colors in zip(keys, material, term):
+        variants[f"{scheme_name}/{mode}"] = {'scheme': scheme_name, 'darkmode': mode == 'dark', 'colors': {**material_colors, **term_colors}}
+    return {
+        'version': 1,
+        'source': {'path': os.path.abspath(args.path)} if args.path is not None else {'color': args.color},
+        'seed': argb_to_hex(hct.to_int()),
+        'transparent': args.transparency == 'transparent',
+        'variants': variants,
+    }
+
+def generate (args):
+    if args.analyze is not None:
+        if args.path is None:
+            parser.error('--analyze needs --path')
+        analysis = json.dumps(analyze_wallpaper(args.path, args.size, args.screen, not args.no_palette_cache))
+        if args.analyze == '-':
+            print(analysis)
         else:
-            harmonized = harmonize(hex_to_argb(val), primary_color_argb, args.harmonize_threshold, args.harmony)
-            harmonized = boost_chroma_tone(harmonized, 1, 1 + (args.term_fg_boost * (1 if darkmode else -1)))
-        term_colors[color] = argb_to_hex(harmonized)
-
-if args.debug == False:
-    print(f"$darkmode: {darkmode};")
-    print(f"$transparent: {transparent};")
-    for color, code in material_colors.items():
-        print(f"${color}: {code};")
-    for color, code in term_colors.items():
-        print(f"${color}: {code};")
-else:
+            write_if_changed(args.analyze, analysis + '\n')
+        return
+
+    darkmode = (args.mode == 'dark')
+    transparent = (args.transparency == 'transparent')
+
     if args.path is not None:
-        print('\n--------------Image properties-----------------')
-        print(f"Image size: {wsize} x {hsize}")
-        print(f"Resized image: {wsize_new} x {hsize_new}")
-    print('\n---------------Selected color------------------')
-    print(f"Dark mode: {darkmode}")
-    print(f"Scheme: {args.scheme}")
-    print(f"Accent color: {display_color(rgba_from_argb(argb))} {argb_to_hex(argb)}")
-    print(f"HCT: {hct.hue:.2f}  {hct.chroma:.2f}  {hct.tone:.2f}")
-    print('\n---------------Material colors-----------------')
-    for color, code in material_colors.items():
-        rgba = rgba_from_argb(hex_to_argb(code))
-        print(f"{color.ljust(32)} : {display_color(rgba)}  {code}")
-    print('\n----------Harmonize terminal colors------------')
-    for color, code in term_colors.items():
-        rgba = rgba_from_argb(hex_to_argb(code))
-        code_source = term_source_colors[color]
-        rgba_source = rgba_from_argb(hex_to_argb(code_source))
-        print(f"{color.ljust(6)} : {display_color(rgba_source)} {code_source} --> {display_color(rgba)} {code}")
-    print('-----------------------------------------------')
+        palette = cached_image_palette(args.path, args.size, not args.no_palette_cache)
+        wsize, hsize = palette['image_size']
+        wsize_new, hsize_new = palette['resized_size']
+        argb = palette['ranked'][0]
+
+        if args.cache is not None:
+            with open(args.cache, 'w') as file:
+                file.write(argb_to_hex(argb))
+        hct = Hct.from_int(argb)
+        if(args.smart):
+            args.scheme = smart_scheme(args.scheme, hct)
+    elif args.color is not None:
+        argb = hex_to_argb(args.color)
+        hct = Hct.from_int(argb)
+
+    termscheme = None
+    if args.termscheme is not None:
+        with open(args.termscheme, 'r') as f:
+            termscheme = json.loads(f.read())
+    material_colors, term_colors = scheme_variant(hct, args.scheme, darkmode, args, termscheme)
+
+    if args.render is not None:
+        render_theme(args.render, darkmode, transparent, {**material_colors, **term_colors}, not args.no_terminal, args.term_alpha)
+
+    if args.variants is not None:
+        # The image was only decoded and quantized once, for all of them
+        bundle = variants_bundle(hct, args, termscheme)
+        variants_output = args.variants_output
+        if variants_output is None and args.render is not None:
+            variants_output = os.path.join(args.render, 'color_variants.json')
+        if variants_output is None:
+            print(json.dumps(bundle, indent=2))
+            return
+        write_if_changed(variants_output, json.dumps(bundle, indent=2) + '\n')
+
+    if args.debug == False:
+        print(theme_scss(darkmode, transparent, {**material_colors, **term_colors}), end='')
+    else:
+        if args.path is not None:
+            print('\n--------------Image properties-----------------')
+            print(f"Image size: {wsize} x {hsize}")
+            print(f"Resized image: {wsize_new} x {hsize_new}")
+            print(f"Decoded from: {palette.get('decoded_from', 'full')}")
+        print('\n---------------Selected color------------------')
+        print(f"Dark mode: {darkmode}")
+        print(f"Scheme: {args.scheme}")
+        print(f"Accent color: {display_color(rgba_from_argb(argb))} {argb_to_hex(argb)}")
+        print(f"HCT: {hct.hue:.2f}  {hct.chroma:.2f}  {hct.tone:.2f}")
+        print('\n---------------Material colors-----------------')
+        for color, code in material_colors.items():
+            rgba = rgba_from_argb(hex_to_argb(code))
+            print(f"{color.ljust(32)} : {display_color(rgba)}  {code}")
+        print('\n----------Harmonize terminal colors------------')
+        for color, code in term_colors.items():
+            rgba = rgba_from_argb(hex_to_argb(code))
+            code_source = termscheme['dark' if darkmode else 'light'][color]
+            rgba_source = rgba_from_argb(hex_to_argb(code_source))
+            print(f"{color.ljust(6)} : {display_color(rgba_source)} {code_source} --> {display_color(rgba)} {code}")
+        print('-----------------------------------------------')
+
+def write_if_changed (path: str, content: str) -> bool:
+    """Atomically replaces the file, unless it already has this content. Returns whether it wrote."""
+    with contextlib.suppress(OSError):
+        with open(path) as f:
+            if f.read() == content:
+                return False
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(temp_path, 'w') as f:
+            f.write(content)
+        os.replace(temp_path, path)
+    finally:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(temp_path)
+    return True
+
+def fill_template (template: str, colors: dict, term_alpha: int) -> str:
+    def substitute (match):
+        if match.group(1) is None:
+            return str(term_alpha)
+        value = colors.get(match.group(1))
+        return match.group(0) if value is None else value.lstrip('#')
+    return TEMPLATE_PLACEHOLDER.sub(substitute, template)
+
+def reload_kitty ():
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        with contextlib.suppress(OSError):
+            with open(f'/proc/{pid}/comm') as f:
+                if f.read().strip() == 'kitty':
+                    os.kill(int(pid), signal.SIGUSR1)
+
+def send_to_terminals (sequences: str):
+    for name in os.listdir('/dev/pts'):
+        if not name.isdigit():
+            continue
+        # Non blocking, a stopped terminal shouldn't hold up the rest
+        with contextlib.suppress(OSError):
+            fd = os.open(f'/dev/pts/{name}', os.O_WRONLY | os.O_NONBLOCK | os.O_NOCTTY)
+            try:
+                os.write(fd, sequences.encode())
+            finally:
+                os.close(fd)
+
+def theme_scss (darkmode: bool, transparent: bool, colors: dict) -> str:
+    lines = [f"$darkmode: {darkmode};", f"$transparent: {transparent};"]
+    lines += [f"${color}: {code};" for color, code in colors.items()]
+    return '\n'.join(lines) + '\n'
+
+def render_theme (out_dir: str, darkmode: bool, transparent: bool, colors: dict, terminal: bool = True, term_alpha: int = 89):
+    """
+    Writes every theme file from the colors in one pass, leaving unchanged files (and
+    the terminals showing them) alone.
+    """
+    write_if_changed(os.path.join(out_dir, 'material_colors.scss'), theme_scss(darkmode, transparent, colors))
+    palette = {'darkmode': darkmode, 'transparent': transparent, 'colors': colors}
+    write_if_changed(os.path.join(out_dir, 'material_colors.json'), json.dumps(palette, indent=2) + '\n')
+    if not terminal:
+        return
+    # Everything the scss has, like the old sed loop over it
+    placeholders = {'darkmode': str(darkmode), 'transparent': str(transparent), **colors}
+    for name, template_path in TERMINAL_TEMPLATES.items():
+        try:
+            with open(template_path) as f:
+                template = f.read()
+        except OSError:
+            print(f"Template file {template_path} not found, skipping it", file=sys.stderr)
+            continue
+        content = fill_template(template, placeholders, term_alpha)
+        if not write_if_changed(os.path.join(out_dir, 'terminal', name), content):
+            continue
+        if name == 'kitty-theme.conf':
+            reload_kitty()
+        else:
+            send_to_terminals(content)
+
+def batch_entry (path: str, options: dict):
+    """Palette index entry of one image, runs in a pool worker. Returns (path, entry, error)."""
+    try:
+        st = os.stat(path)
+        palette = cached_image_palette(path, options['size'], options['use_cache'])
+    except Exception as e: # Anything PIL can't make sense of
+        return path, None, str(e)
+    argb = palette['ranked'][0]
+    hct = Hct.from_int(argb)
+    if options['scheme'] == 'auto':
+        # Same pick as switchwall.sh's auto type, from a reduced decode like --analyze
+        import scheme_for_image
+        try:
+            image, original_size, _ = decode_reduced(path, colorfulness_size)
+            scheme_name = scheme_for_image.pick_scheme(colorfulness_of(colorfulness_bitmap(image, original_size)))
+        except Exception:
+            scheme_name = 'scheme-tonal-spot'
+    elif options['smart']:
+        scheme_name = smart_scheme(options['scheme'], hct)
+    else:
+        scheme_name = options['scheme']
+    Scheme = get_scheme_class(scheme_name)
+    return path, {
+        'file_size': st.st_size,
+        'mtime_ns': st.st_mtime_ns,
+        'seed': argb_to_hex(argb),
+        'hue': round(hct.hue, 2),
+        'chroma': round(hct.chroma, 2),
+        'tone': round(hct.tone, 2),
+        'scheme': scheme_name,
+        'dark': material_colors_of(Scheme(hct, True, 0.0), PREVIEW_ROLES),
+        'light': material_colors_of(Scheme(hct, False, 0.0), PREVIEW_ROLES),
+    }, None
+
+def batch (args):
+    """
+    Precomputes seed color, scheme choice and preview colors of many images into one JSON
+    index, so the wallpaper picker can show them without running anything. Entries are
+    keyed by absolute path and only recomputed when the file's size or mtime changes.
+    """
+    if args.batch == '-':
+        paths = [line.strip() for line in sys.stdin if line.strip()]
+    else:
+        paths = sorted(entry.path for entry in os.scandir(args.batch)
+                       if entry.is_file() and entry.name.lower().endswith(BATCH_EXTENSIONS))
+    index_path = args.index or PALETTE_INDEX_PATH
+    # Entries made with other settings are worthless
+    settings = {'size': args.size, 'scheme': args.scheme, 'smart': args.smart, 'roles': PREVIEW_ROLES}
+    try:
+        with open(index_path) as f:
+            index = json.load(f)
+        if index.get('version') != PALETTE_INDEX_VERSION or index.get('settings') != settings:
+            index = None
+    except (OSError, ValueError):
+        index = None
+    if index is None:
+        index = {'version': PALETTE_INDEX_VERSION, 'settings': settings, 'files': {}}
+    files = index['files']
+    for path in [path for path in files if not os.path.exists(path)]:
+        del files[path]
+
+    stale = []
+    # Absolute, not real paths: those are what the wallpaper picker looks them up by
+    for path in dict.fromkeys(os.path.abspath(path) for path in paths):
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        entry = files.get(path)
+        if entry is None or (entry['file_size'], entry['mtime_ns']) != (st.st_size, st.st_mtime_ns):
+            stale.append(path)
+
+    if stale:
+        options = {'size': args.size, 'use_cache': not args.no_palette_cache,
+                   'scheme': args.scheme, 'smart': args.smart}
+        from multiprocessing import Pool
+        with Pool(processes=max(1, min(args.workers, len(stale)))) as pool:
+            for path, entry, error in pool.imap_unordered(functools.partial(batch_entry, options=options), stale):
+                if entry is None:
+                    print(f"{path}: {error}", file=sys.stderr)
+                    files.pop(path, None)
+                else:
+                    files[path] = entry
+
+    # Atomic, Wallpapers.qml reloads it as soon as it changes
+    os.makedirs(os.path.dirname(os.path.abspath(index_path)), exist_ok=True)
+    temp_path = f"{index_path}.{os.getpid()}.tmp"
+    try:
+        with open(temp_path, 'w') as f:
+            json.dump(index, f, separators=(',', ':'))
+        os.replace(temp_path, index_path)
+    finally:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(temp_path)
+    print(f"Indexed {len(stale)} of {len(paths)} images in {index_path}")
+
+SCHEMES = ['scheme-content', 'scheme-expressive', 'scheme-fidelity', 'scheme-fruit-salad', 'scheme-monochrome',
+           'scheme-neutral', 'scheme-rainbow', 'scheme-tonal-spot', 'scheme-vibrant']
+
+def handle_request (request: dict) -> dict:
+    """Runs one generation the way the command line would, with its output captured."""
+    import traceback
+    stdout, stderr = io.StringIO(), io.StringIO()
+    exit_code = 0
+    with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+        try:
+            # Relative paths (--path, --termscheme, --cache) are relative to the client
+            os.chdir(request.get('cwd', '/'))
+            request_args = parser.parse_args(request['argv'])
+            if request_args.serve is not None or request_args.batch is not None:
+                parser.error('--serve and --batch can only be used on the command line')
+            generate(request_args)
+        except SystemExit as e:
+            exit_code = e.code if isinstance(e.code, int) else 1
+        except Exception:
+            traceback.print_exc()
+            exit_code = 1
+    return {'exit_code': exit_code, 'stdout': stdout.getvalue(), 'stderr': stderr.getvalue()}
+
+def serve (socket_path: str):
+    """
+    Keeps PIL, materialyoucolor and every scheme class loaded and answers one JSON
+    request per connection: {"argv": [...], "cwd": "..."} in, {"exit_code", "stdout",
+    "stderr"} out. Requests are handled one at a time, in order.
+    """
+    import socket
+    # Everything a request can need, loaded up front
+    import PIL.Image, materialyoucolor.quantize, materialyoucolor.score.score, hct_numpy, scheme_for_image
+    for scheme_name in SCHEMES:
+        get_scheme_class(scheme_name)
+    script_mtime = os.path.getmtime(__file__)
+
+    os.makedirs(os.path.dirname(socket_path), mode=0o700, exist_ok=True)
+    with contextlib.suppress(OSError):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+            probe.connect(socket_path)
+            print('Another server is already listening on', socket_path, file=sys.stderr)
+            return
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(socket_path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    server.listen()
+    try:
+        while True:
+            connection, _ = server.accept()
+            connection.settimeout(SERVE_IO_TIMEOUT_SECONDS)
+            # A client that went away or stalled doesn't get to take the server down with it
+            with contextlib.suppress(OSError), connection, connection.makefile('rwb') as stream:
+                try:
+                    request = json.loads(stream.readline())
+                except ValueError:
+                    continue
+                stream.write(json.dumps(handle_request(request)).encode() + b'\n')
+            # An updated script should take effect on the next switch, not the next login
+            if os.path.getmtime(__file__) != script_mtime:
+                break
+    finally:
+        server.close()
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(socket_path)
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.serve is not None:
+        serve(args.serve)
+    elif args.batch is not None:
+        batch(args)
+    else:
+        generate(args)
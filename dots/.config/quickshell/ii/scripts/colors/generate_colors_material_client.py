@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+# Drop-in replacement for running generate_colors_material.py: same arguments, same output
+# and exit code, but the work is done by a resident `generate_colors_material.py --serve`,
+# so no venv activation or heavy imports happen per wallpaper switch.
+# Only uses the standard library on purpose, it runs on the system python.
+import json
+import os
+import socket
+import sys
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVER_SCRIPT = os.path.join(SCRIPT_DIR, 'generate_colors_material.py')
+RUNTIME_DIR = os.environ.get('XDG_RUNTIME_DIR') or '/tmp/quickshell-{}'.format(os.getuid())
+SOCKET_PATH = os.path.join(RUNTIME_DIR, 'quickshell', 'colorgen.sock')
+# Same as run_in_venv from lib/venv.sh
+IN_VENV = ['bash', '-c', 'source "$(eval echo "$ILLOGICAL_IMPULSE_VIRTUAL_ENV")/bin/activate" && exec python3 "$@"', 'bash']
+# Per socket operation, the server handles one request at a time so this includes waiting for others
+TIMEOUT_SECONDS = 15
+
+def request (argv: list) -> dict:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.settimeout(TIMEOUT_SECONDS)
+        client.connect(SOCKET_PATH)
+        with client.makefile('rwb') as stream:
+            stream.write(json.dumps({'argv': argv, 'cwd': os.getcwd()}).encode() + b'\n')
+            stream.flush()
+            return json.loads(stream.readline())
+
+def start_server ():
+    import subprocess # Only needed this once
+    subprocess.Popen(IN_VENV + [SERVER_SCRIPT, '--serve', SOCKET_PATH], stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                     stderr=subprocess.DEVNULL, start_new_session=True)
+
+def main ():
+    argv = sys.argv[1:]
+    try:
+        response = request(argv)
+    except socket.timeout:
+        # A server that hangs (or is stuck behind one that does), don't wait for it
+        os.execvp(IN_VENV[0], IN_VENV + [SERVER_SCRIPT] + argv)
+    except (OSError, ValueError):
+        # No server (yet): start one for next time and do this one the slow way
+        start_server()
+        os.execvp(IN_VENV[0], IN_VENV + [SERVER_SCRIPT] + argv)
+    sys.stdout.write(response['stdout'])
+    sys.stderr.write(response['stderr'])
+    sys.exit(response['exit_code'])
+
+if __name__ == '__main__':
+    main()
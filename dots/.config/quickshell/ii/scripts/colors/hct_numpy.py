@@ -0,0 +1,250 @@
+"""
+NumPy batch versions of materialyoucolor's HCT conversions (CAM16 in the default viewing
+conditions plus L*), for converting and harmonizing whole palettes in one call.
+
+hct_from_argb follows Cam16.from_int and lstar_from_argb, argb_from_hct follows
+HctSolver.solve_to_int: gray colors the same way, then the same Newton rounds on J for
+every color at once, and for colors that don't converge inside the sRGB gamut the same
+bisection toward the gamut boundary, again on all of them at once. Results match the
+scalar path up to the last bits of the trig and pow functions, which can flip an 8 bit
+channel by one in rare cases.
+"""
+import math
+
+import numpy as np
+from materialyoucolor.hct.hct_solver import HctSolver
+from materialyoucolor.hct.viewing_conditions import ViewingConditions
+
+# ViewingConditions.DEFAULT() recomputes these on every call, the batch path does it once
+VIEWING_CONDITIONS = ViewingConditions.make()
+RGB_D = VIEWING_CONDITIONS.rgb_d
+FL = VIEWING_CONDITIONS.fl
+NBB = VIEWING_CONDITIONS.nbb
+AW = VIEWING_CONDITIONS.aw
+CZ = VIEWING_CONDITIONS.c * VIEWING_CONDITIONS.z
+P1_SCALE = (50000.0 / 13.0) * VIEWING_CONDITIONS.nc * VIEWING_CONDITIONS.ncb
+ALPHA_SCALE = math.pow(1.64 - math.pow(0.29, VIEWING_CONDITIONS.n), 0.73)
+T_INNER_COEFF = 1 / ALPHA_SCALE
+
+SRGB_TO_XYZ = [[0.41233895, 0.35762064, 0.18051042], [0.2126, 0.7152, 0.0722], [0.01932141, 0.11916382, 0.95034478]]
+XYZ_TO_CAM16RGB = [[0.401288, 0.650173, -0.051461], [-0.250268, 1.204414, 0.045854], [-0.002079, 0.048952, 0.953127]]
+SCALED_DISCOUNT_FROM_LINRGB = HctSolver.SCALED_DISCOUNT_FROM_LINRGB
+LINRGB_FROM_SCALED_DISCOUNT = HctSolver.LINRGB_FROM_SCALED_DISCOUNT
+Y_FROM_LINRGB = HctSolver.Y_FROM_LINRGB
+CRITICAL_PLANES = np.array(HctSolver.CRITICAL_PLANES)
+NEWTON_ROUNDS = 5
+BISECT_ROUNDS = 8
+
+LAB_E = 216.0 / 24389.0
+LAB_KAPPA = 24389.0 / 27.0
+
+
+def multiply(matrix, columns) -> list:
+    # Term by term in the reference's order, a BLAS matrix product can round differently
+    return [row[0] * columns[0] + row[1] * columns[1] + row[2] * columns[2] for row in matrix]
+
+
+def linearized(channel: np.ndarray) -> np.ndarray:
+    normalized = channel / 255.0
+    return np.where(normalized <= 0.040449936, normalized / 12.92 * 100.0, ((normalized + 0.055) / 1.055) ** 2.4 * 100.0)
+
+
+def delinearized(linear: np.ndarray) -> np.ndarray:
+    normalized = linear / 100.0
+    with np.errstate(invalid='ignore'):
+        gamma = np.where(normalized <= 0.0031308, normalized * 12.92, 1.055 * np.power(normalized, 1.0 / 2.4) - 0.055)
+    # np.rint rounds half to even like Python's round
+    return np.clip(np.rint(gamma * 255), 0, 255).astype(np.int64)
+
+
+def gamma_of(linear: np.ndarray) -> np.ndarray:
+    # HctSolver.true_delinearized, unrounded and unclamped
+    normalized = linear / 100.0
+    with np.errstate(invalid='ignore'):
+        return np.where(normalized <= 0.0031308, normalized * 12.92, 1.055 * np.power(normalized, 1.0 / 2.4) - 0.055) * 255.0
+
+
+def argb_from_linrgb(linrgb) -> np.ndarray:
+    red, green, blue = (delinearized(channel) for channel in linrgb)
+    return (0xFF << 24) | (red << 16) | (green << 8) | blue
+
+
+def y_from_lstar(lstar: np.ndarray) -> np.ndarray:
+    ft = (lstar + 16.0) / 116.0
+    ft3 = ft * ft * ft
+    return 100.0 * np.where(ft3 > LAB_E, ft3, (116 * ft - 16) / LAB_KAPPA)
+
+
+def hct_from_argb(argbs) -> tuple:
+    """Hue, chroma and tone arrays of an array of ARGB ints, like Hct.from_int."""
+    argbs = np.asarray(argbs, dtype=np.int64)
+    red, green, blue = (linearized((argbs >> shift) & 0xFF) for shift in (16, 8, 0))
+    xyz = multiply(SRGB_TO_XYZ, [red, green, blue])
+    rgb_d = [RGB_D[i] * channel for i, channel in enumerate(multiply(XYZ_TO_CAM16RGB, xyz))]
+    r_a, g_a, b_a = [np.sign(d) * 400.0 * af / (af + 27.13) for d, af in ((d, np.power(FL * np.abs(d) / 100.0, 0.42)) for d in rgb_d)]
+
+    a = (11.0 * r_a + -12.0 * g_a + b_a) / 11.0
+    b = (r_a + g_a - 2.0 * b_a) / 9.0
+    u = (20.0 * r_a + 20.0 * g_a + 21.0 * b_a) / 20.0
+    p2 = (40.0 * r_a + 20.0 * g_a + b_a) / 20.0
+    hue = np.arctan2(b, a) * 180.0 / math.pi
+    hue = np.where(hue < 0, hue + 360.0, hue)
+
+    j = 100.0 * np.power(p2 * NBB / AW, CZ)
+    hue_prime = np.where(hue < 20.14, hue + 360, hue)
+    e_hue = 0.25 * (np.cos(hue_prime * math.pi / 180.0 + 2.0) + 3.8)
+    t = P1_SCALE * e_hue * np.sqrt(a * a + b * b) / (u + 0.305)
+    chroma = np.power(t, 0.9) * ALPHA_SCALE * np.sqrt(j / 100.0)
+
+    y = xyz[1] / 100.0
+    tone = 116.0 * np.where(y > LAB_E, np.power(y, 1.0 / 3.0), (LAB_KAPPA * y + 16) / 116) - 16.0
+    return hue, chroma, tone
+
+
+def find_results_by_j(hue_radians: np.ndarray, chroma: np.ndarray, y: np.ndarray) -> np.ndarray:
+    """HctSolver.find_result_by_j for every color at once, 0 where it gives up too."""
+    result = np.zeros(hue_radians.shape, dtype=np.int64)
+    active = np.ones(hue_radians.shape, dtype=bool)
+    j = np.sqrt(y) * 11.0
+    p1 = 0.25 * (np.cos(hue_radians + 2.0) + 3.8) * P1_SCALE
+    h_sin, h_cos = np.sin(hue_radians), np.cos(hue_radians)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for iteration_round in range(NEWTON_ROUNDS):
+            j_normalized = j / 100.0
+            alpha = np.where((chroma != 0.0) & (j != 0.0), chroma / np.sqrt(j_normalized), 0.0)
+            t = np.power(alpha * T_INNER_COEFF, 1.0 / 0.9)
+            p2 = AW * np.power(j_normalized, 1.0 / CZ) / NBB
+            gamma = 23.0 * (p2 + 0.305) * t / (23.0 * p1 + 11 * t * h_cos + 108.0 * t * h_sin)
+            a, b = gamma * h_cos, gamma * h_sin
+            adapted = [(460.0 * p2 + 451.0 * a + 288.0 * b) / 1403.0,
+                       (460.0 * p2 - 891.0 * a - 261.0 * b) / 1403.0,
+                       (460.0 * p2 - 220.0 * a - 6300.0 * b) / 1403.0]
+            scaled = [np.sign(c) * np.power(np.maximum(0, 27.13 * np.abs(c) / (400.0 - np.abs(c))), 1.0 / 0.42) for c in adapted]
+            linrgb = multiply(LINRGB_FROM_SCALED_DISCOUNT, scaled)
+            fnj = Y_FROM_LINRGB[0] * linrgb[0] + Y_FROM_LINRGB[1] * linrgb[1] + Y_FROM_LINRGB[2] * linrgb[2]
+
+            # NaN fails every comparison, so only plain numbers count as converged
+            failed = (linrgb[0] < 0) | (linrgb[1] < 0) | (linrgb[2] < 0) | ~(fnj > 0)
+            done = active & ~failed & ((iteration_round == NEWTON_ROUNDS - 1) | (np.abs(fnj - y) < 0.002))
+            in_gamut = (linrgb[0] <= 100.01) & (linrgb[1] <= 100.01) & (linrgb[2] <= 100.01)
+            found = done & in_gamut
+            if found.any():
+                result[found] = argb_from_linrgb([channel[found] for channel in linrgb])
+            active &= ~(failed | done)
+            if not active.any():
+                break
+            j = np.where(active, j - (fnj - y) * j / (2 * fnj), j)
+    return result
+
+
+def hue_of(linrgb) -> np.ndarray:
+    scaled_discount = multiply(SCALED_DISCOUNT_FROM_LINRGB, linrgb)
+    r_a, g_a, b_a = [np.sign(c) * 400.0 * af / (af + 27.13) for c, af in ((c, np.power(np.abs(c), 0.42)) for c in scaled_discount)]
+    return np.arctan2((r_a + g_a - 2.0 * b_a) / 9.0, (11.0 * r_a + -12.0 * g_a + b_a) / 11.0)
+
+
+def in_cyclic_order(a, b, c) -> np.ndarray:
+    return (b - a + math.pi * 8) % (math.pi * 2) < (c - a + math.pi * 8) % (math.pi * 2)
+
+
+def nth_vertex(y: np.ndarray, n: int) -> tuple:
+    """Vertex n of the plane of constant y through the RGB cube, and where it's inside the cube."""
+    coord_a = 0.0 if n % 4 <= 1 else 100.0
+    coord_b = 0.0 if n % 2 == 0 else 100.0
+    coord_a, coord_b = np.full_like(y, coord_a), np.full_like(y, coord_b)
+    if n < 4:
+        vertex = [(y - coord_a * Y_FROM_LINRGB[1] - coord_b * Y_FROM_LINRGB[2]) / Y_FROM_LINRGB[0], coord_a, coord_b]
+        solved = vertex[0]
+    elif n < 8:
+        vertex = [coord_b, (y - coord_b * Y_FROM_LINRGB[0] - coord_a * Y_FROM_LINRGB[2]) / Y_FROM_LINRGB[1], coord_a]
+        solved = vertex[1]
+    else:
+        vertex = [coord_a, coord_b, (y - coord_a * Y_FROM_LINRGB[0] - coord_b * Y_FROM_LINRGB[1]) / Y_FROM_LINRGB[2]]
+        solved = vertex[2]
+    return vertex, (solved >= 0.0) & (solved <= 100.0)
+
+
+def bisect_to_limit(y: np.ndarray, target_hue: np.ndarray) -> list:
+    """HctSolver.bisect_to_limit for every color at once: the linear RGB on the gamut
+    boundary with y's luminance closest to target_hue."""
+    left = [np.full_like(y, -1.0) for _ in range(3)]
+    right = [channel.copy() for channel in left]
+    left_hue, right_hue = np.zeros_like(y), np.zeros_like(y)
+    initialized = np.zeros(y.shape, dtype=bool)
+    uncut = np.ones(y.shape, dtype=bool)
+    for n in range(12):
+        mid, valid = nth_vertex(y, n)
+        mid_hue = hue_of(mid)
+        first = valid & ~initialized
+        cut = valid & initialized & (uncut | in_cyclic_order(left_hue, mid_hue, right_hue))
+        uncut &= ~cut
+        to_right = first | (cut & in_cyclic_order(left_hue, target_hue, mid_hue))
+        to_left = first | (cut & ~to_right)
+        right = [np.where(to_right, m, r) for m, r in zip(mid, right)]
+        right_hue = np.where(to_right, mid_hue, right_hue)
+        left = [np.where(to_left, m, l) for m, l in zip(mid, left)]
+        left_hue = np.where(to_left, mid_hue, left_hue)
+        initialized |= first
+
+    left_hue = hue_of(left)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for axis in range(3):
+            differs = left[axis] != right[axis]
+            increasing = left[axis] < right[axis]
+            left_gamma, right_gamma = (gamma_of(channel[axis]) - 0.5 for channel in (left, right))
+            l_plane = np.where(increasing, np.floor(left_gamma), np.ceil(left_gamma)).astype(np.int64)
+            r_plane = np.where(increasing, np.ceil(right_gamma), np.floor(right_gamma)).astype(np.int64)
+            for _ in range(BISECT_ROUNDS):
+                active = differs & (np.abs(r_plane - l_plane) > 1)
+                if not active.any():
+                    break
+                m_plane = np.where(active, (l_plane + r_plane) // 2, 0)
+                # Like the reference's list, plane -1 is the last one
+                t = (CRITICAL_PLANES[m_plane] - left[axis]) / (right[axis] - left[axis])
+                mid = [l + (r - l) * t for l, r in zip(left, right)]
+                mid_hue = hue_of(mid)
+                to_right = active & in_cyclic_order(left_hue, target_hue, mid_hue)
+                to_left = active & ~to_right
+                right = [np.where(to_right, m, r) for m, r in zip(mid, right)]
+                r_plane = np.where(to_right, m_plane, r_plane)
+                left = [np.where(to_left, m, l) for m, l in zip(mid, left)]
+                left_hue = np.where(to_left, mid_hue, left_hue)
+                l_plane = np.where(to_left, m_plane, l_plane)
+    return [(l + r) / 2 for l, r in zip(left, right)]
+
+
+def argb_from_hct(hue, chroma, tone) -> np.ndarray:
+    """ARGB ints of hue, chroma and tone arrays, like Hct.from_hct(...).to_int()."""
+    hue, chroma, tone = np.broadcast_arrays(*(np.asarray(value, dtype=np.float64) for value in (hue, chroma, tone)))
+    gray = (chroma < 0.0001) | (tone < 0.0001) | (tone > 99.9999)
+    component = delinearized(y_from_lstar(tone))
+    result = np.where(gray, (0xFF << 24) | (component << 16) | (component << 8) | component, 0)
+
+    colorful = ~gray
+    if colorful.any():
+        hue_radians = (hue[colorful] % 360.0) / 180 * math.pi
+        y = y_from_lstar(tone[colorful])
+        exact = find_results_by_j(hue_radians, chroma[colorful], y)
+        # Out of gamut or not converged, the closest color on the gamut boundary instead
+        missed = exact == 0
+        if missed.any():
+            exact[missed] = argb_from_linrgb(bisect_to_limit(y[missed], hue_radians[missed]))
+        result[colorful] = exact
+    return result
+
+
+def harmonize(design_colors, source_colors, threshold: float = 35, harmony: float = 0.5) -> np.ndarray:
+    """Design colors rotated toward the hue of their source colors (one, or one each), like the scalar harmonize()."""
+    from_hue, from_chroma, from_tone = hct_from_argb(design_colors)
+    to_hue = hct_from_argb(source_colors)[0]
+    difference_degrees = 180.0 - np.abs(np.abs(from_hue - to_hue) - 180.0)
+    rotation_degrees = np.minimum(difference_degrees * harmony, threshold)
+    rotation_direction = np.where((to_hue - from_hue) % 360.0 <= 180.0, 1.0, -1.0)
+    return argb_from_hct((from_hue + rotation_degrees * rotation_direction) % 360.0, from_chroma, from_tone)
+
+
+def boost_chroma_tone(argbs, chroma=1, tone=1) -> np.ndarray:
+    """Scales chroma and tone of every color, either factor can be an array too."""
+    hue, current_chroma, current_tone = hct_from_argb(argbs)
+    return argb_from_hct(hue, current_chroma * chroma, current_tone * tone)
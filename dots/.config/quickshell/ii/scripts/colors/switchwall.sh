@@ -12,6 +12,7 @@ source "$SCRIPT_DIR/../lib/venv.sh"
 SHELL_CONFIG_FILE="$XDG_CONFIG_HOME/illogical-impulse/config.json"
 MATUGEN_DIR="$XDG_CONFIG_HOME/matugen"
 terminalscheme="$SCRIPT_DIR/terminal/scheme-base.json"
+analysis_file="$STATE_DIR/user/generated/wallpaper_analysis.json"
 
 handle_kde_material_you_colors() {
     if [ -f "$SHELL_CONFIG_FILE" ]; then
@@ -60,7 +61,7 @@ post_process() {
 CUSTOM_DIR="$XDG_CONFIG_HOME/hypr/custom"
 RESTORE_SCRIPT_DIR="$CUSTOM_DIR/scripts"
 RESTORE_SCRIPT="$RESTORE_SCRIPT_DIR/__restore_video_wallpaper.sh"
-THUMBNAIL_DIR="$RESTORE_SCRIPT_DIR/mpvpaper_thumbnails"
+VIDEO_FRAMES_DIR="$CACHE_DIR/video-frames" # Shared with thumbgen.py
 VIDEO_OPTS="no-audio loop hwdec=auto scale=bilinear interpolation=no video-sync=display-resample panscan=1.0 video-scale-x=1.0 video-scale-y=1.0 video-align-x=0.5 video-align-y=0.5 load-scripts=no"
 
 is_video() {
@@ -140,7 +141,7 @@ switch() {
         kill_existing_mpvpaper
 
         if is_video "$imgpath"; then
-            mkdir -p "$THUMBNAIL_DIR"
+            mkdir -p "$VIDEO_FRAMES_DIR"
 
             missing_deps=()
             if ! command -v mpvpaper &> /dev/null; then
@@ -176,8 +177,12 @@ switch() {
                 sleep 0.1
             done
 
-            thumbnail="$THUMBNAIL_DIR/$(basename "$imgpath").jpg"
-            ffmpeg -y -i "$imgpath" -vframes 1 "$thumbnail" 2>/dev/null
+            # Same key as thumbgen.py, so a frame it already grabbed is reused as is
+            thumbnail="$VIDEO_FRAMES_DIR/$(printf '%s' "$(realpath "$imgpath")" | md5sum | cut -d' ' -f1).jpg"
+            if [[ ! "$thumbnail" -nt "$imgpath" ]]; then
+                "$SCRIPT_DIR/../thumbnails/thumbgen-venv.sh" --video_frame "$imgpath" >/dev/null 2>&1 \
+                    || ffmpeg -y -skip_frame nokey -i "$imgpath" -vframes 1 "$thumbnail" 2>/dev/null
+            fi
 
             set_thumbnail_path "$thumbnail"
 
@@ -236,12 +241,15 @@ switch() {
         [[ "$harmony" != "null" && -n "$harmony" ]] && generate_colors_material_args+=(--harmony "$harmony")
         [[ "$harmonize_threshold" != "null" && -n "$harmonize_threshold" ]] && generate_colors_material_args+=(--harmonize_threshold "$harmonize_threshold")
         [[ "$term_fg_boost" != "null" && -n "$term_fg_boost" ]] && generate_colors_material_args+=(--term_fg_boost "$term_fg_boost")
+        enable_terminal=$(jq -r '.appearance.wallpaperTheming.enableTerminal' "$SHELL_CONFIG_FILE")
+        [[ "$enable_terminal" != "true" ]] && generate_colors_material_args+=(--no_terminal)
     fi
+    # Writes the scss, its JSON twin and the terminal themes, and reloads terminals whose theme changed
+    generate_colors_material_args+=(--render "$STATE_DIR/user/generated")
 
     matugen "${matugen_args[@]}"
-    run_in_venv python3 "$SCRIPT_DIR/generate_colors_material.py" "${generate_colors_material_args[@]}" \
-        > "$STATE_DIR"/user/generated/material_colors.scss
-    "$SCRIPT_DIR"/applycolor.sh
+    # Talks to a resident generate_colors_material.py (starting it if needed), same arguments and output
+    python3 "$SCRIPT_DIR/generate_colors_material_client.py" "${generate_colors_material_args[@]}" > /dev/null
 
     max_width_desired="$(hyprctl monitors -j | jq '([.[].width] | min)' | xargs)"
     max_height_desired="$(hyprctl monitors -j | jq '([.[].height] | min)' | xargs)"
@@ -267,9 +275,18 @@ main() {
         jq --arg color "$color" '.appearance.palette.accentColor = $color' "$SHELL_CONFIG_FILE" > "$SHELL_CONFIG_FILE.tmp" && mv "$SHELL_CONFIG_FILE.tmp" "$SHELL_CONFIG_FILE"
     }
 
+    analyze_image() {
+        local img="$1"
+        local screen screen_args=()
+        screen="$(hyprctl monitors -j 2>/dev/null | jq -r '"\([.[].width] | min)x\([.[].height] | min)"' 2>/dev/null)"
+        [[ "$screen" =~ ^[0-9]+x[0-9]+$ ]] && screen_args=(--screen "$screen")
+        # One decode for the scheme type, the seed (cached for the generation below) and the widgets,
+        # done by the resident color generator instead of a fresh interpreter
+        python3 "$SCRIPT_DIR/generate_colors_material_client.py" --path "$img" --analyze "$analysis_file" "${screen_args[@]}" >/dev/null 2>&1
+    }
     detect_scheme_type_from_image() {
         local img="$1"
-        run_in_venv "$SCRIPT_DIR"/scheme_for_image.py "$img" 2>/dev/null | tr -d '\n'
+        analyze_image "$img" && jq -r '.scheme' "$analysis_file" 2>/dev/null | tr -d '\n'
     }
 
     while [[ $# -gt 0 ]]; do
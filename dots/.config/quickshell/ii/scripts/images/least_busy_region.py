@@ -1,11 +1,27 @@
 #!/usr/bin/env python3
 
+import contextlib
+import hashlib
 import json
+import os
+import shutil
 import sys
 
 import cv2
 import numpy as np
 
+XDG_CACHE_HOME = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+CACHE_DIR = os.path.join(XDG_CACHE_HOME, "quickshell", "least-busy-region")
+# Least recently used entries go first, a 4K screen takes about 100 MB
+CACHE_MAX_BYTES = 512 * 1024 * 1024
+# Bump when what gets cached (or how it's computed) changes
+CACHE_VERSION = 1
+# The color summary is the screen sized wallpaper, this many times smaller on each side
+COLOR_SUMMARY_SCALE = 4
+# Bits per channel of the dominant color histogram, and how many pixels it's computed from at most
+HISTOGRAM_BITS = 4
+HISTOGRAM_MAX_PIXELS = 4096
+
 
 def center_crop(img, target_w, target_h):
     h, w = img.shape[:2]
@@ -20,6 +36,8 @@ def center_crop(img, target_w, target_h):
 
 def scale_to_screen(img, screen_width, screen_height):
     orig_h, orig_w = img.shape[:2]
+    if orig_w == screen_width and orig_h == screen_height:
+        return img
     scale = max(screen_width / orig_w, screen_height / orig_h)
     new_w = int(orig_w * scale)
     new_h = int(orig_h * scale)
@@ -27,32 +45,80 @@ def scale_to_screen(img, screen_width, screen_height):
     return center_crop(img, screen_width, screen_height)
 
 
-def region_sum(ii, x1, y1, x2, y2):
-    total = ii[y2, x2]
-    if x1 > 0:
-        total -= ii[y2, x1 - 1]
-    if y1 > 0:
-        total -= ii[y1 - 1, x2]
-    if x1 > 0 and y1 > 0:
-        total += ii[y1 - 1, x1 - 1]
-    return total
+def window_sums(integral, xs, ys, region_width, region_height):
+    """
+    Sum of every region_width x region_height window with its top left corner in the
+    xs by ys slices, from an integral image that starts with a row and column of zeros.
+    """
 
+    def corner(dx, dy):
+        return integral[ys.start + dy : ys.stop + dy : ys.step, xs.start + dx : xs.stop + dx : xs.step]
 
-def find_extreme_region(
-    img,
-    region_width,
-    region_height,
-    screen_width,
-    screen_height,
-    horizontal_padding,
-    vertical_padding,
-    busiest,
-    stride=10,
-):
-    img = scale_to_screen(img, screen_width, screen_height)
-    arr = img.astype(np.float64)
-    h, w = arr.shape
-    stride = max(1, stride)
+    sums = corner(region_width, region_height) - corner(0, region_height)
+    sums -= corner(region_width, 0)
+    sums += corner(0, 0)
+    return sums
+
+
+def window_variances(img, xs, ys, region_width, region_height, dtype=np.float64, integrals=None):
+    """
+    Variance of every window with its top left corner in the xs by ys slices, rows first.
+    Uses the (integral, squared integral) pair of img instead of img when given.
+    """
+    area = region_width * region_height
+    if integrals is not None or dtype == np.float64:
+        # Sums of 8 bit pixels and their squares are exact in doubles, no need to convert first
+        if integrals is None:
+            integrals = cv2.integral2(img, sdepth=cv2.CV_64F, sqdepth=cv2.CV_64F)
+        integral, integral_sq = integrals
+        integrals = None
+        # Integer integrals may wrap around in between, the window sums themselves fit
+        mean = window_sums(integral, xs, ys, region_width, region_height).astype(np.float64, copy=False)
+        del integral
+        variance = window_sums(integral_sq, xs, ys, region_width, region_height).astype(np.float64, copy=False)
+        del integral_sq
+        # (s2 / area) - (s / area)**2, in place
+        np.divide(mean, area, out=mean)
+        np.divide(variance, area, out=variance)
+        np.square(mean, out=mean)
+        variance -= mean
+        return variance.astype(dtype, copy=False)
+    # A float32 integral of a whole screen loses most of its precision. Box filters only ever
+    # sum one window (in double internally), and centering keeps the squares small.
+    arr = img[ys.start : ys.stop - 1 + region_height, xs.start : xs.stop - 1 + region_width].astype(np.float32)
+    arr -= arr.mean()
+    kernel = (region_width, region_height)
+    mean = cv2.boxFilter(arr, -1, kernel, anchor=(0, 0), borderType=cv2.BORDER_CONSTANT)[:: ys.step, :: xs.step]
+    np.square(arr, out=arr)
+    variance = cv2.boxFilter(arr, -1, kernel, anchor=(0, 0), borderType=cv2.BORDER_CONSTANT)[:: ys.step, :: xs.step]
+    del arr
+    # Only windows that fit entirely, the box filter computes the rest too
+    rows, columns = len(range(ys.start, ys.stop, ys.step)), len(range(xs.start, xs.stop, xs.step))
+    mean, variance = mean[:rows, :columns], variance[:rows, :columns]
+    np.square(mean, out=mean)
+    variance -= mean
+    return variance
+
+
+def overlapping_windows(xs, ys, region_width, region_height, taken):
+    """Mask of the windows in the xs by ys slices that overlap one of the taken rectangles, rows first."""
+    columns = np.arange(xs.start, xs.stop, xs.step)
+    rows = np.arange(ys.start, ys.stop, ys.step)
+    blocked = np.zeros((len(rows), len(columns)), dtype=bool)
+    for x, y, width, height in taken:
+        in_columns = (columns > x - region_width) & (columns < x + width)
+        in_rows = (rows > y - region_height) & (rows < y + height)
+        blocked |= np.outer(in_rows, in_columns)
+    return blocked
+
+
+def candidate_area(w, h, region_width, region_height, horizontal_padding, vertical_padding):
+    """
+    Region size clamped to the padded image, and the first and last top left corner a
+    window can have horizontally and vertically, or None if there's no room for any.
+    """
+    if region_width < 1 or region_height < 1:
+        raise ValueError("Region must be at least 1x1.")
     if horizontal_padding * 2 >= w or vertical_padding * 2 >= h:
         horizontal_padding = max(0, min(horizontal_padding, (w - 1) // 2))
         vertical_padding = max(0, min(vertical_padding, (h - 1) // 2))
@@ -62,34 +128,184 @@ def find_extreme_region(
         raise ValueError("Image too small for the specified padding.")
     region_width = min(region_width, max_region_w)
     region_height = min(region_height, max_region_h)
-    integral = cv2.integral(arr, sdepth=cv2.CV_64F)[1:, 1:]
-    integral_sq = cv2.integral(arr**2, sdepth=cv2.CV_64F)[1:, 1:]
-    area = region_width * region_height
-    best_var = None
-    best_coords = (horizontal_padding, vertical_padding)
     x_start = horizontal_padding
     y_start = vertical_padding
-    x_end = max(x_start, w - region_width - horizontal_padding + 1)
-    y_end = max(y_start, h - region_height - vertical_padding + 1)
-    for y in range(y_start, y_end + 1, stride):
-        for x in range(x_start, x_end + 1, stride):
-            x2 = x + region_width - 1
-            y2 = y + region_height - 1
-            if x2 >= w or y2 >= h:
-                continue
-            s = region_sum(integral, x, y, x2, y2)
-            s2 = region_sum(integral_sq, x, y, x2, y2)
-            mean = s / area
-            var = (s2 / area) - (mean**2)
-            if best_var is None or (
-                (var < best_var) if not busiest else (var > best_var)
-            ):
-                best_var = var
-                best_coords = (x, y)
-    return best_coords, best_var
-
-
-def get_dominant_color(img, x, y, w, h, screen_width, screen_height):
+    # Windows sticking out of the image aren't candidates
+    x_end = min(max(x_start, w - region_width - horizontal_padding + 1), w - region_width)
+    y_end = min(max(y_start, h - region_height - vertical_padding + 1), h - region_height)
+    if x_end < x_start or y_end < y_start:
+        return None
+    return region_width, region_height, (x_start, x_end), (y_start, y_end)
+
+
+def find_extreme_region(
+    img,
+    region_width,
+    region_height,
+    screen_width,
+    screen_height,
+    horizontal_padding,
+    vertical_padding,
+    busiest,
+    stride=1,
+    dtype=np.float64,
+    taken=(),
+    integrals=None,
+):
+    """
+    Top left corner and variance of the least (or most) busy window. Windows overlapping
+    any of the taken (x, y, width, height) rectangles are skipped, unless all of them do.
+    With integrals (see screen_canvas) img isn't needed and can be None.
+    """
+    if integrals is None:
+        img = scale_to_screen(img, screen_width, screen_height)
+        h, w = img.shape
+    else:
+        h, w = integrals[0].shape[0] - 1, integrals[0].shape[1] - 1
+    stride = max(1, stride)
+    area = candidate_area(w, h, region_width, region_height, horizontal_padding, vertical_padding)
+    if area is None:
+        return (horizontal_padding, vertical_padding), None
+    region_width, region_height, (x_start, x_end), (y_start, y_end) = area
+    xs, ys = slice(x_start, x_end + 1, stride), slice(y_start, y_end + 1, stride)
+    variances = window_variances(img, xs, ys, region_width, region_height, dtype, integrals)
+    if taken:
+        blocked = overlapping_windows(xs, ys, region_width, region_height, taken)
+        if not blocked.all():
+            variances[blocked] = -np.inf if busiest else np.inf
+    # First in row major order on ties, like scanning row by row
+    index = np.argmax(variances) if busiest else np.argmin(variances)
+    row, column = np.unravel_index(index, variances.shape)
+    return (x_start + int(column) * stride, y_start + int(row) * stride), float(variances[row, column])
+
+
+def region_variances(integrals, x0, y0, width, height):
+    """
+    Variance of the windows with their top left corners at columns x0 (a row vector) and
+    rows y0 (a column vector), of the given sizes, which broadcast the same way.
+    """
+    integral, integral_sq = integrals
+    x1, y1 = x0 + width, y0 + height
+
+    def sums(table):
+        # Only the corners get read, a memory mapped table stays mostly on disk
+        total = table[y1, x1] - table[y0, x1].astype(np.float64)
+        total -= table[y1, x0]
+        total += table[y0, x0]
+        return total
+
+    area = width * height
+    mean = sums(integral) / area
+    return sums(integral_sq) / area - mean * mean
+
+
+def find_extreme_region_pyramid(
+    integrals,
+    region_width,
+    region_height,
+    horizontal_padding,
+    vertical_padding,
+    busiest,
+    cell=16,
+    max_cells=64,
+    tolerance=0.0,
+    taken=(),
+):
+    """
+    find_extreme_region without looking at every window. Windows are grouped in cells of
+    cell x cell top left corners, and a bound on the variance of every window in a cell
+    is computed from a single window per cell. Cells are then searched window by window,
+    most promising bound first, until no other cell can hold a better window than the best
+    one so far (plus tolerance), or max_cells were searched.
+
+    Returns the top left corner, the variance and how much worse than the exhaustive
+    search's that variance can be at most, 0 when it's the same window.
+    """
+    h, w = integrals[0].shape[0] - 1, integrals[0].shape[1] - 1
+    area = candidate_area(w, h, region_width, region_height, horizontal_padding, vertical_padding)
+    if area is None:
+        return (horizontal_padding, vertical_padding), None, 0.0
+    region_width, region_height, (x_start, x_end), (y_start, y_end) = area
+    cell = max(1, min(cell, region_width, region_height))
+    # The last cells of a row or column can be smaller
+    cells_x = np.arange(x_start, x_end + 1, cell)[None, :]
+    cells_y = np.arange(y_start, y_end + 1, cell)[:, None]
+    cells_w = np.minimum(cell, x_end + 1 - cells_x)
+    cells_h = np.minimum(cell, y_end + 1 - cells_y)
+    window_area = region_width * region_height
+    # Minimizing the variance, or its opposite for the busiest window. Squared deviations
+    # from the mean only add up over more pixels, and the mean is the value they're the
+    # smallest around, so no window is calmer than the intersection of a cell's windows
+    # and none is busier than their union, relative to their areas.
+    if busiest:
+        union_w, union_h = region_width + cells_w - 1, region_height + cells_h - 1
+        union = region_variances(integrals, cells_x, cells_y, union_w, union_h)
+        bounds = -union * (union_w * union_h) / window_area
+    else:
+        inner_w, inner_h = region_width - cells_w + 1, region_height - cells_h + 1
+        inner = region_variances(integrals, cells_x + cells_w - 1, cells_y + cells_h - 1, inner_w, inner_h)
+        bounds = inner * (inner_w * inner_h) / window_area
+    # So that rounding can't make a bound exclude the exact answer
+    bounds -= 1e-9 * (1 + np.abs(bounds))
+    for x, y, width, height in taken:
+        # Cells whose every window overlaps the same taken one have nothing to offer
+        inside_x = (cells_x > x - region_width) & (cells_x + cells_w - 1 < x + width)
+        inside_y = (cells_y > y - region_height) & (cells_y + cells_h - 1 < y + height)
+        bounds[inside_y & inside_x] = np.inf
+
+    order = np.argsort(bounds, axis=None, kind="stable")
+    # Score, then row major order on ties like the exhaustive search
+    best = (np.inf, 0, 0)
+    error_bound = 0.0
+    for searched, index in enumerate(order):
+        bound = float(bounds.flat[index])
+        # Not strictly better than the best so far can still be a tie earlier in row major order
+        if bound > best[0] or (tolerance > 0 and best[0] - bound <= tolerance) or searched == max_cells:
+            error_bound = max(0.0, best[0] - bound)
+            break
+        row, column = np.unravel_index(index, bounds.shape)
+        x0, y0 = int(cells_x[0, column]), int(cells_y[row, 0])
+        columns, rows = int(cells_w[0, column]), int(cells_h[row, 0])
+        scores = region_variances(
+            integrals, np.arange(x0, x0 + columns)[None, :], np.arange(y0, y0 + rows)[:, None], region_width, region_height
+        )
+        if busiest:
+            np.negative(scores, out=scores)
+        if taken:
+            scores[overlapping_windows(slice(x0, x0 + columns), slice(y0, y0 + rows), region_width, region_height, taken)] = np.inf
+        cell_row, cell_column = np.unravel_index(np.argmin(scores), scores.shape)
+        best = min(best, (float(scores[cell_row, cell_column]), y0 + int(cell_row), x0 + int(cell_column)))
+    if best[0] == np.inf:
+        # Every window searched overlaps a taken one
+        coords, variance = find_extreme_region(
+            None, region_width, region_height, w, h, horizontal_padding, vertical_padding, busiest, taken=taken, integrals=integrals
+        )
+        return coords, variance, 0.0
+    score, y, x = best
+    return (x, y), (-score if busiest else score), error_bound
+
+
+def histogram_peak(pixels):
+    """
+    Mean of the pixels around the fullest cell of a coarse color histogram, always the
+    same for the same pixels.
+    """
+    levels = 1 << HISTOGRAM_BITS
+    bins = pixels >> (8 - HISTOGRAM_BITS)
+    index = (bins[:, 0].astype(np.intp) * levels + bins[:, 1]) * levels + bins[:, 2]
+    counts = np.bincount(index, minlength=levels**3).reshape((levels, levels, levels))
+    # A color on the edge of a cell spreads over its neighbors, count them along
+    padded = np.pad(counts, 1)
+    smoothed = sum(
+        padded[i : i + levels, j : j + levels, k : k + levels] for i in range(3) for j in range(3) for k in range(3)
+    )
+    peak = np.array(np.unravel_index(np.argmax(smoothed), smoothed.shape))
+    near = np.all(np.abs(bins.astype(np.int16) - peak) <= 1, axis=1)
+    return pixels[near].mean(axis=0)
+
+
+def get_dominant_color(img, x, y, w, h, screen_width, screen_height, engine="histogram"):
+    """RGB of the region's most common color, by histogram_peak or k-means (random, and slower)."""
     img = scale_to_screen(img, screen_width, screen_height)
     x = max(0, x)
     y = max(0, y)
@@ -98,71 +314,315 @@ def get_dominant_color(img, x, y, w, h, screen_width, screen_height):
     region = img[y : y + h, x : x + w]
     if region.size == 0 or region.shape[0] == 0 or region.shape[1] == 0:
         return [0, 0, 0]
+    if engine == "histogram" and w * h > HISTOGRAM_MAX_PIXELS:
+        scale = (HISTOGRAM_MAX_PIXELS / (w * h)) ** 0.5
+        region = cv2.resize(region, (max(1, int(w * scale)), max(1, int(h * scale))), interpolation=cv2.INTER_AREA)
     region = region.reshape((-1, 3))
     non_black = region[np.any(region > 10, axis=1)]
     if non_black.shape[0] == 0:
         non_black = region
-    region = np.float32(non_black)
-    if region.shape[0] < 3:
-        return [int(x) for x in np.mean(region, axis=0)]
-    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 10, 1.0)
-    K = min(3, region.shape[0])
-    _, labels, centers = cv2.kmeans(
-        region, K, None, criteria, 10, cv2.KMEANS_RANDOM_CENTERS
-    )
-    counts = np.bincount(labels.flatten())
-    dominant = centers[np.argmax(counts)]
+    if engine == "histogram":
+        dominant = histogram_peak(non_black)
+    elif non_black.shape[0] < 3:
+        dominant = np.mean(non_black, axis=0)
+    else:
+        region = np.float32(non_black)
+        criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 10, 1.0)
+        K = min(3, region.shape[0])
+        _, labels, centers = cv2.kmeans(
+            region, K, None, criteria, 10, cv2.KMEANS_RANDOM_CENTERS
+        )
+        counts = np.bincount(labels.flatten())
+        dominant = centers[np.argmax(counts)]
     return [int(x) for x in reversed(dominant)]
 
 
+def screen_canvas(img, screen_width, screen_height):
+    """
+    The (integral, squared integral) pair of the wallpaper as seen on the screen, and
+    a color summary of it, everything widget placement needs.
+    """
+    img = scale_to_screen(img, screen_width, screen_height)
+    # int32 is exact up to about 4K, and half the size
+    sdepth = cv2.CV_32S if screen_width * screen_height * 255 < 2**31 else cv2.CV_64F
+    integrals = cv2.integral2(cv2.cvtColor(img, cv2.COLOR_BGR2GRAY), sdepth=sdepth, sqdepth=cv2.CV_64F)
+    return integrals, color_summary(img)
+
+
+def color_summary(img):
+    """The screen sized color image, COLOR_SUMMARY_SCALE times smaller on each side."""
+    h, w = img.shape[:2]
+    summary_size = (max(1, w // COLOR_SUMMARY_SCALE), max(1, h // COLOR_SUMMARY_SCALE))
+    return cv2.resize(img, summary_size, interpolation=cv2.INTER_AREA)
+
+
+def canvas_cache_entry(image_path, screen_width, screen_height):
+    """Cache entry name of the wallpaper's canvas, and the prefix shared by all versions of the file."""
+    st = os.stat(image_path)
+    path_key = f"{CACHE_VERSION}\0{os.path.realpath(image_path)}"
+    prefix = hashlib.sha256(path_key.encode(errors="surrogateescape")).hexdigest()[:32]
+    file_key = hashlib.sha256(f"{st.st_size}\0{st.st_mtime_ns}".encode()).hexdigest()[:16]
+    return f"{prefix}-{file_key}-{screen_width}x{screen_height}", prefix
+
+
+def load_canvas(entry_name, screen_width, screen_height):
+    entry_path = os.path.join(CACHE_DIR, entry_name)
+    try:
+        # Memory mapped, only the pages the search touches get read
+        integrals = (
+            np.load(os.path.join(entry_path, "integral.npy"), mmap_mode="r"),
+            np.load(os.path.join(entry_path, "integral_sq.npy"), mmap_mode="r"),
+        )
+        colors = np.load(os.path.join(entry_path, "colors.npy"))
+    except (OSError, ValueError):
+        return None
+    if any(integral.shape != (screen_height + 1, screen_width + 1) for integral in integrals):
+        return None
+    # The mtime is the last use, for eviction
+    with contextlib.suppress(OSError):
+        os.utime(entry_path)
+    return integrals, colors
+
+
+def store_canvas(entry_name, prefix, integrals, colors):
+    """
+    Atomic, so other processes only ever see complete entries, then drops the entries of
+    older versions of the same wallpaper and trims the cache to size.
+    """
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    entry_path = os.path.join(CACHE_DIR, entry_name)
+    temp_path = f"{entry_path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(temp_path, exist_ok=True)
+        np.save(os.path.join(temp_path, "integral.npy"), integrals[0])
+        np.save(os.path.join(temp_path, "integral_sq.npy"), integrals[1])
+        np.save(os.path.join(temp_path, "colors.npy"), colors)
+        # Fails if someone else stored it first, theirs is just as good
+        with contextlib.suppress(OSError):
+            os.rename(temp_path, entry_path)
+    finally:
+        shutil.rmtree(temp_path, ignore_errors=True)
+
+    file_key = entry_name.split("-")[1]
+    entries = []
+    for entry in os.scandir(CACHE_DIR):
+        if entry.name.endswith(".tmp"):
+            continue
+        if entry.name.startswith(prefix + "-") and entry.name.split("-")[1] != file_key:
+            shutil.rmtree(entry.path, ignore_errors=True)
+            continue
+        with contextlib.suppress(OSError):
+            size = sum(file.stat().st_size for file in os.scandir(entry.path))
+            entries.append((entry.stat().st_mtime, size, entry.path))
+    entries.sort(reverse=True)
+    total = 0
+    for i, (_, size, old_entry_path) in enumerate(entries):
+        total += size
+        # Always keep the newest one, even if it's bigger than the whole cache
+        if i > 0 and total > CACHE_MAX_BYTES:
+            # Someone else may be evicting too
+            shutil.rmtree(old_entry_path, ignore_errors=True)
+
+
+def cached_screen_canvas(image_path, screen_width, screen_height, use_cache=True):
+    """screen_canvas of the image at image_path, or None if it can't be read."""
+    entry = None
+    if use_cache:
+        with contextlib.suppress(OSError):
+            entry = canvas_cache_entry(image_path, screen_width, screen_height)
+            cached = load_canvas(entry[0], screen_width, screen_height)
+            if cached is not None:
+                return cached
+    img = cv2.imread(image_path)
+    if img is None:
+        return None
+    integrals, colors = screen_canvas(img, screen_width, screen_height)
+    if entry is not None:
+        # Not being able to cache isn't worth failing over
+        with contextlib.suppress(OSError):
+            store_canvas(*entry, integrals, colors)
+    return integrals, colors
+
+
+def place_region(
+    gray_img,
+    integrals,
+    colors,
+    region_width,
+    region_height,
+    screen_width,
+    screen_height,
+    padding_x,
+    padding_y,
+    busiest,
+    dtype=np.float64,
+    taken=(),
+    pyramid=False,
+    color_engine="histogram",
+):
+    if pyramid:
+        coords, variance, error_bound = find_extreme_region_pyramid(
+            integrals,
+            region_width=region_width,
+            region_height=region_height,
+            horizontal_padding=padding_x,
+            vertical_padding=padding_y,
+            busiest=busiest,
+            taken=taken,
+        )
+    else:
+        coords, variance = find_extreme_region(
+            gray_img,
+            region_width=region_width,
+            region_height=region_height,
+            screen_width=screen_width,
+            screen_height=screen_height,
+            horizontal_padding=padding_x,
+            vertical_padding=padding_y,
+            busiest=busiest,
+            dtype=dtype,
+            taken=taken,
+            integrals=integrals,
+        )
+    # Same region in the color summary
+    summary_height, summary_width = colors.shape[:2]
+    dominant_color = get_dominant_color(
+        colors,
+        coords[0] * summary_width // screen_width,
+        coords[1] * summary_height // screen_height,
+        max(1, region_width * summary_width // screen_width),
+        max(1, region_height * summary_height // screen_height),
+        summary_width,
+        summary_height,
+        engine=color_engine,
+    )
+    result = {
+        "center_x": coords[0] + region_width // 2,
+        "center_y": coords[1] + region_height // 2,
+        "width": region_width,
+        "height": region_height,
+        "variance": variance,
+        "dominant_color": "#{:02x}{:02x}{:02x}".format(*dominant_color),
+    }
+    if pyramid:
+        result["error_bound"] = error_bound
+    return coords, result
+
+
+def read_widgets(text):
+    """
+    Parses the batch mode widget list, e.g.
+    [{"width": 300, "height": 300, "padding_x": 200, "padding_y": 200, "strategy": "least"}]
+    """
+    widgets = json.loads(sys.stdin.read() if text == "-" else text)
+    if not isinstance(widgets, list):
+        raise ValueError("expected a list of widgets")
+    for widget in widgets:
+        if widget.get("strategy", "least") not in ("least", "most"):
+            raise ValueError(f"unknown strategy: {widget['strategy']}")
+    return [
+        (
+            int(widget["width"]),
+            int(widget["height"]),
+            int(widget.get("padding_x", 0)),
+            int(widget.get("padding_y", 0)),
+            widget.get("strategy", "least") == "most",
+        )
+        for widget in widgets
+    ]
+
+
 def main():
+    """
+    least_busy_region.py [OPTIONS] IMAGE SCREEN_W SCREEN_H WIDTH HEIGHT PADDING_X PADDING_Y least|most
+    least_busy_region.py [OPTIONS] --batch IMAGE SCREEN_W SCREEN_H WIDGETS_JSON|-
+    OPTIONS: --float32, --no-cache, --pyramid, --kmeans
+
+    Batch mode places the widgets in list order, each one avoiding the ones placed
+    before it, and prints a list with an object per widget. The wallpaper's integral
+    images are cached per screen size, except with --float32, which searches the pixels.
+    --pyramid searches only where the best window can be, see find_extreme_region_pyramid,
+    and adds its error_bound to the output. --kmeans picks the dominant color with k-means
+    instead of a histogram, like it used to.
+    """
     args = sys.argv[1:]
-    if len(args) != 8 or args[7] not in ("least", "most"):
-        sys.exit(2)
+    # Half the memory for the search, at float32 precision
+    dtype = np.float64
+    if "--float32" in args:
+        dtype = np.float32
+        args.remove("--float32")
+    use_cache = "--no-cache" not in args
+    if not use_cache:
+        args.remove("--no-cache")
+    pyramid = "--pyramid" in args
+    if pyramid:
+        args.remove("--pyramid")
+        # It only works with integrals
+        dtype = np.float64
+    color_engine = "histogram"
+    if "--kmeans" in args:
+        color_engine = "kmeans"
+        args.remove("--kmeans")
+    batch = "--batch" in args
+    if batch:
+        args.remove("--batch")
+        if len(args) != 4:
+            sys.exit(2)
+        try:
+            widgets = read_widgets(args[3])
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            sys.stderr.write(f"Invalid widget list: {e}\n")
+            sys.exit(2)
+    else:
+        if len(args) != 8 or args[7] not in ("least", "most"):
+            sys.exit(2)
+        widgets = [tuple(int(x) for x in args[3:7]) + (args[7] == "most",)]
+    for region_width, region_height, *_ in widgets:
+        # An empty window has no variance, only a division by zero
+        if region_width < 1 or region_height < 1:
+            sys.stderr.write(f"Invalid region size: {region_width}x{region_height}\n")
+            sys.exit(2)
     image_path = args[0]
-    screen_width, screen_height, region_width, region_height, padding_x, padding_y = (
-        int(x) for x in args[1:7]
-    )
-    busiest = args[7] == "most"
+    screen_width, screen_height = int(args[1]), int(args[2])
 
-    gray_img = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
-    color_img = cv2.imread(image_path)
-    if gray_img is None or color_img is None:
+    # Decode and scale once for every widget, or not at all when cached
+    gray_img, integrals, colors = None, None, None
+    if dtype == np.float64:
+        canvas = cached_screen_canvas(image_path, screen_width, screen_height, use_cache)
+        if canvas is not None:
+            integrals, colors = canvas
+    else:
+        color_img = cv2.imread(image_path)
+        if color_img is not None:
+            color_img = scale_to_screen(color_img, screen_width, screen_height)
+            gray_img = cv2.cvtColor(color_img, cv2.COLOR_BGR2GRAY)
+            colors = color_summary(color_img)
+            del color_img
+    if colors is None:
         sys.stderr.write(f"Image not found: {image_path}\n")
         sys.exit(1)
 
-    coords, variance = find_extreme_region(
-        gray_img,
-        region_width=region_width,
-        region_height=region_height,
-        screen_width=screen_width,
-        screen_height=screen_height,
-        horizontal_padding=padding_x,
-        vertical_padding=padding_y,
-        busiest=busiest,
-    )
-    dominant_color = get_dominant_color(
-        color_img,
-        coords[0],
-        coords[1],
-        region_width,
-        region_height,
-        screen_width,
-        screen_height,
-    )
-    dominant_color_hex = "#{:02x}{:02x}{:02x}".format(*dominant_color)
-    print(
-        json.dumps(
-            {
-                "center_x": coords[0] + region_width // 2,
-                "center_y": coords[1] + region_height // 2,
-                "width": region_width,
-                "height": region_height,
-                "variance": variance,
-                "dominant_color": dominant_color_hex,
-            }
+    results, taken = [], []
+    for region_width, region_height, padding_x, padding_y, busiest in widgets:
+        coords, result = place_region(
+            gray_img,
+            integrals,
+            colors,
+            region_width,
+            region_height,
+            screen_width,
+            screen_height,
+            padding_x,
+            padding_y,
+            busiest,
+            dtype=dtype,
+            taken=taken,
+            pyramid=pyramid,
+            color_engine=color_engine,
         )
-    )
+        results.append(result)
+        taken.append((coords[0], coords[1], region_width, region_height))
+    print(json.dumps(results if batch else results[0]))
 
 
 if __name__ == "__main__":
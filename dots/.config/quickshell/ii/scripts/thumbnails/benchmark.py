@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+"""
+Throughput benchmark for thumbgen.py. Builds a synthetic wallpaper corpus (seeded,
+so every run gets the same files), runs thumbgen.py over it for every combination
+of engine, worker count, sizes and cache state, and prints the results as JSON.
+
+Run it with the same Python thumbgen.py uses, e.g.
+    source ../lib/venv.sh && run_in_venv python3 benchmark.py --workers 1,4 --output bench.json
+Everything happens offline, in a temporary XDG_CACHE_HOME per run.
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+from PIL import Image
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+THUMBGEN = os.path.join(SCRIPT_DIR, "thumbgen.py")
+RESULT_VERSION = 1
+
+RESOLUTIONS = {
+    "1080p": (1920, 1080),
+    "1440p": (2560, 1440),
+    "4k": (3840, 2160),
+    "5k": (5120, 2880),
+    "8k": (7680, 4320),
+}
+FORMATS = ["jpg", "png", "webp", "gif"]
+RSS_POLL_SECONDS = 0.05
+
+
+def synthetic_wallpaper(rng, width, height):
+    # Smooth shapes from an upscaled random grid plus a bit of grain, compresses
+    # roughly like a photo instead of like flat color or pure noise
+    grid = Image.fromarray(rng.integers(0, 256, (9, 16, 3), dtype=np.uint8))
+    base = np.asarray(grid.resize((width, height), Image.Resampling.BICUBIC), dtype=np.int16)
+    grain = rng.integers(-6, 7, (height, width, 1), dtype=np.int16)
+    return Image.fromarray(np.clip(base + grain, 0, 255).astype(np.uint8))
+
+
+def build_corpus(path, *, count, formats, resolutions, seed):
+    """Creates the corpus unless the one at path was made with the same parameters."""
+    # Next to the corpus, thumbgen would try to thumbnail it otherwise
+    manifest_path = path.rstrip("/") + ".json"
+    manifest = {"count": count, "formats": formats, "resolutions": resolutions, "seed": seed}
+    try:
+        with open(manifest_path) as f:
+            if json.load(f) == manifest:
+                return manifest
+    except (OSError, ValueError):
+        pass
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+    rng = np.random.default_rng(seed)
+    for i in range(count):
+        fmt = formats[i % len(formats)]
+        resolution = resolutions[(i // len(formats)) % len(resolutions)]
+        image = synthetic_wallpaper(rng, *RESOLUTIONS[resolution])
+        fpath = os.path.join(path, "{:04d}-{}.{}".format(i, resolution, fmt))
+        if fmt == "jpg":
+            image.save(fpath, "JPEG", quality=90)
+        elif fmt == "png":
+            image.save(fpath, "PNG")
+        elif fmt == "webp":
+            image.save(fpath, "WEBP", quality=90)
+        else:
+            image.quantize(256).save(fpath, "GIF")
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f)
+    return manifest
+
+
+def descendant_pids(pid):
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open("/proc/{}/stat".format(entry)) as f:
+                # The command name can contain spaces, the fields after it can't
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    pids, stack = [], [pid]
+    while stack:
+        for child in children.get(stack.pop(), []):
+            pids.append(child)
+            stack.append(child)
+    return pids
+
+
+def peak_rss_kb(pid):
+    try:
+        with open("/proc/{}/status".format(pid)) as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def watch_rss(process, peaks, stop):
+    """Samples the high water mark of thumbgen and each of its workers until it exits."""
+    while not stop.is_set():
+        for pid in [process.pid] + descendant_pids(process.pid):
+            rss = peak_rss_kb(pid)
+            if rss is not None:
+                peaks[pid] = max(peaks.get(pid, 0), rss)
+        stop.wait(RSS_POLL_SECONDS)
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, round(fraction * (len(values) - 1)))]
+
+
+def run_thumbgen(*, corpus, corpus_files, cache_home, engine, workers, sizes, use_index):
+    env = dict(os.environ, XDG_CACHE_HOME=cache_home, GIO_USE_VFS="local")
+    command = [sys.executable, THUMBGEN, "-d", corpus, "--engine", engine, "--sizes", sizes, "-w", str(workers), "--machine_progress"]
+    if not use_index:
+        command.append("--no_index")
+    peaks, stop = {}, threading.Event()
+    start = time.perf_counter()
+    process = subprocess.Popen(command, env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    sampler = threading.Thread(target=watch_rss, args=(process, peaks, stop), daemon=True)
+    sampler.start()
+    files, done = [], None
+    for line in process.stdout:
+        if not line.startswith("{"):
+            continue
+        event = json.loads(line)
+        if event.get("event") == "file":
+            files.append(event)
+        elif event.get("event") == "done":
+            done = event
+    process.wait()
+    wall = time.perf_counter() - start
+    stop.set()
+    sampler.join()
+
+    latencies = [round(event["decode_ms"] + event["encode_ms"], 2) for event in files]
+    statuses = {}
+    for event in files:
+        statuses[event["status"]] = statuses.get(event["status"], 0) + 1
+    worker_peaks = [rss for pid, rss in peaks.items() if pid != process.pid]
+    return {
+        "exit_code": process.returncode,
+        # Files thumbgen looked at, a warm run with the index skips the fresh ones before they get here
+        "files": len(files),
+        "statuses": statuses,
+        "wall_s": round(wall, 3),
+        # Only counts the thumbnailing, not interpreter start up and directory scanning
+        "files_per_sec": done["files_per_sec"] if done else None,
+        "wall_files_per_sec": round(corpus_files / wall, 2),
+        "latency_ms": {
+            "p50": percentile(latencies, 0.5),
+            "p99": percentile(latencies, 0.99),
+            "max": max(latencies, default=None),
+            "mean": round(statistics.fmean(latencies), 2) if latencies else None,
+        },
+        "bytes_read": sum(event["bytes_read"] for event in files),
+        "bytes_written": sum(event["bytes_written"] for event in files),
+        "peak_rss_kb": {
+            "main": peaks.get(process.pid),
+            "worker_max": max(worker_peaks, default=None),
+            "workers": sorted(worker_peaks),
+        },
+    }
+
+
+def available_engines():
+    engines = ["pillow"]
+    probe = "import gi; gi.require_version('GnomeDesktop', '4.0'); from gi.repository import GnomeDesktop"
+    if subprocess.run([sys.executable, "-c", probe], capture_output=True).returncode == 0:
+        engines.insert(0, "gnome")
+    return engines
+
+
+def split_list(text):
+    return [item for item in text.split(",") if item]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark thumbgen.py on a synthetic wallpaper corpus")
+    parser.add_argument("--corpus", default=os.path.join(tempfile.gettempdir(), "thumbgen-benchmark-corpus"), help="where to build (or reuse) the corpus")
+    parser.add_argument("--count", type=int, default=24, help="number of wallpapers in the corpus")
+    parser.add_argument("--formats", default=",".join(FORMATS), help="comma separated, from: " + ", ".join(FORMATS))
+    parser.add_argument("--resolutions", default="1080p,1440p,4k,8k", help="comma separated, from: " + ", ".join(RESOLUTIONS))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--engines", default=None, help="comma separated, default: every engine that can run here")
+    parser.add_argument("--workers", default=str(os.cpu_count() or 1), help="comma separated worker counts")
+    parser.add_argument("--sizes", default="normal", help="';' separated --sizes values for thumbgen, e.g. 'normal;normal,large'")
+    parser.add_argument("--caches", default="cold,warm", help="cold (empty cache), warm (everything already thumbnailed) or both")
+    parser.add_argument("--no_index", action="store_true", help="run thumbgen without its freshness index")
+    parser.add_argument("--repeat", type=int, default=1, help="runs per combination")
+    parser.add_argument("--output", default=None, help="write the JSON here instead of stdout")
+    args = parser.parse_args()
+
+    formats, resolutions, caches = split_list(args.formats), split_list(args.resolutions), split_list(args.caches)
+    for name, values, known in (("format", formats, FORMATS), ("resolution", resolutions, RESOLUTIONS), ("cache", caches, ["cold", "warm"])):
+        for value in values:
+            if value not in known:
+                parser.error("unknown {} '{}'".format(name, value))
+    engines = split_list(args.engines) if args.engines else available_engines()
+    corpus = build_corpus(args.corpus, count=args.count, formats=formats, resolutions=resolutions, seed=args.seed)
+
+    runs = []
+    for engine in engines:
+        for workers in [int(w) for w in split_list(args.workers)]:
+            for sizes in [s for s in args.sizes.split(";") if s]:
+                for repeat in range(args.repeat):
+                    with tempfile.TemporaryDirectory(prefix="thumbgen-benchmark-") as cache_home:
+                        # Warm runs reuse the cold run's cache, thumbnails and freshness index alike
+                        for cache in ["cold", "warm"]:
+                            if cache == "warm" and "warm" not in caches:
+                                break
+                            result = run_thumbgen(corpus=args.corpus, corpus_files=args.count, cache_home=cache_home, engine=engine, workers=workers, sizes=sizes, use_index=not args.no_index)
+                            if cache in caches:
+                                runs.append({"engine": engine, "workers": workers, "sizes": sizes, "cache": cache, "repeat": repeat, **result})
+                                print("{engine} -w {workers} --sizes {sizes} {cache}: {wall_files_per_sec} files/s".format(**runs[-1]), file=sys.stderr)
+
+    report = {
+        "version": RESULT_VERSION,
+        "machine": {"cpus": os.cpu_count(), "python": platform.python_version(), "platform": platform.platform()},
+        "corpus": corpus,
+        "runs": runs,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -4,79 +4,1174 @@
 # Since the script is small and the maintainers seem inactive to accept my PR (#11) I decided to just copy it over.
 # When it gets merged and the python package gets updated we can just use it
 
+import contextlib
+import ctypes
+import hashlib
+import io
+import json
+import math
+import mimetypes
 import os
+import queue
+import select
+import shutil
+import signal
+import sqlite3
+import struct
+import subprocess
 import sys
+import threading
+import time
+import urllib.parse
 from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 from pathlib import Path
-from typing import List, Union
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
 
-import gi
 from loguru import logger
 from tqdm import tqdm
 
-gi.require_version("GnomeDesktop", "4.0")
-from gi.repository import Gio, GnomeDesktop  # isort:skip
+# Each engine only needs its own dependencies
+try:
+    import gi
+    gi.require_version("GnomeDesktop", "4.0")
+    gi.require_version("GdkPixbuf", "2.0")
+    from gi.repository import GdkPixbuf, Gio, GnomeDesktop  # isort:skip
+except (ImportError, ValueError):
+    GdkPixbuf = Gio = GnomeDesktop = None
+try:
+    from PIL import Image, ImageOps, PngImagePlugin, UnidentifiedImageError
+except ImportError:
+    Image = None
 
-thumbnail_size_map = {
-    "normal": GnomeDesktop.DesktopThumbnailSize.NORMAL,
-    "large": GnomeDesktop.DesktopThumbnailSize.LARGE,
-    "x-large": GnomeDesktop.DesktopThumbnailSize.XLARGE,
-    "xx-large": GnomeDesktop.DesktopThumbnailSize.XXLARGE,
+ENGINES = ["gnome", "pillow"]
+
+if GnomeDesktop is not None:
+    thumbnail_size_map = {
+        "normal": GnomeDesktop.DesktopThumbnailSize.NORMAL,
+        "large": GnomeDesktop.DesktopThumbnailSize.LARGE,
+        "x-large": GnomeDesktop.DesktopThumbnailSize.XLARGE,
+        "xx-large": GnomeDesktop.DesktopThumbnailSize.XXLARGE,
+    }
+# Edge length of each size, see https://specifications.freedesktop.org/thumbnail-spec/latest/directory.html
+thumbnail_pixels = {
+    "normal": 128,
+    "large": 256,
+    "x-large": 512,
+    "xx-large": 1024,
 }
 
-factory = None
+IMAGE_SUFFIXES = [".jpg", ".jpeg", ".png", ".gif"]
+VIDEO_SUFFIXES = [".mp4", ".webm", ".mkv", ".avi", ".mov"]
+
+XDG_CACHE_HOME = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+INDEX_PATH = os.path.join(XDG_CACHE_HOME, "quickshell", "thumbgen", "index.sqlite3")
+# Files that failed (ERROR or UNSUPPORTED) are tried again after this long, or as soon as
+# the engine's version changes, a new thumbnailer or loader may handle them now
+INDEX_FAILURE_RETRY_SECONDS = 7 * 24 * 60 * 60
+# Full size video frames, named after the md5 of the video's real path so that
+# switchwall.sh can find them without asking us (see video_frame_path())
+VIDEO_FRAMES_DIR = os.path.join(XDG_CACHE_HOME, "quickshell", "video-frames")
+# Where in a video its frame is taken from, the first frames are often black
+VIDEO_FRAME_POSITION = 0.1
+VIDEO_TIMEOUT_SECONDS = 30
+# Characters g_filename_to_uri() leaves alone, so our thumbnail names match GLib's
+URI_SAFE_CHARS = "/!$&'()*+,:=@~"
+
+# Scheduling: files are grouped into chunks of roughly equal cost, using the
+# file size plus a fixed per-file overhead as the cost estimate
+CHUNKS_PER_WORKER = 4
+CHUNK_FILE_OVERHEAD = 64 * 1024
+MAX_CHUNK_FILES = 8
+# Chunks only save IPC round trips, which stop mattering once a chunk takes a while
+MAX_CHUNK_BYTES = 4 * 1024 * 1024
+# Chunks handed to the pool ahead of time, kept low so priority changes take effect quickly
+CHUNKS_IN_FLIGHT_PER_WORKER = 2
+
+# inotify(7) flags, see <sys/inotify.h>
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+# IN_MODIFY is deliberately left out: it fires for every write() while a file is
+# being copied in, IN_CLOSE_WRITE is the "modification finished" signal we want.
+WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+# How long the directory has to be quiet before a batch of changes is processed
+WATCH_DEBOUNCE_SECONDS = 0.2
+# Upper bound for the debounce so a continuous stream of events still gets handled
+WATCH_MAX_DELAY_SECONDS = 2.0
+
+# Bumped whenever a --machine_progress event changes incompatibly
+PROGRESS_VERSION = 1
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# Thumbnailers put their tEXt chunks in front of the image data, give up on
+# anything that needs more than this to get there
+PNG_HEADER_READ_LIMIT = 64 * 1024
+GC_STAMP_PATH = os.path.join(XDG_CACHE_HOME, "quickshell", "thumbgen", "last-gc")
+# The background pass skips itself if a full one ran more recently than this
+GC_INTERVAL_SECONDS = 24 * 60 * 60
+# Leftovers of an interrupted atomic write, nothing is still writing to them
+GC_TEMP_FILE_AGE_SECONDS = 60 * 60
+
+engine = "gnome"
+factories = {}
 logger.remove()
 logger.add(sys.stdout, level="INFO")
 logger.add("/tmp/thumbgen.log", level="DEBUG", rotation="100 MB")
 
-def make_thumbnail(fpath: str) -> bool:
+def file_uri(fpath: str) -> str:
+    return "file://" + urllib.parse.quote_from_bytes(os.fsencode(os.path.abspath(fpath)), safe=URI_SAFE_CHARS)
+
+
+def thumbnail_path(fpath: str, size: str) -> str:
+    md5 = hashlib.md5(file_uri(fpath).encode()).hexdigest()
+    return os.path.join(XDG_CACHE_HOME, "thumbnails", size, md5 + ".png")
+
+
+def guess_mime_type(fpath: str, f) -> str:
+    # The extension is right for practically every wallpaper and costs nothing,
+    # Gio's content sniffing opens and reads the file
+    mime_type, _ = mimetypes.guess_type(fpath, strict=False)
+    if mime_type is not None:
+        return mime_type
+    info = f.query_info("standard::content-type", Gio.FileQueryInfoFlags.NONE, None)
+    return info.get_content_type()
+
+
+def sort_sizes(sizes: List[str]) -> List[str]:
+    return sorted(set(sizes), key=thumbnail_pixels.get, reverse=True)
+
+
+def init_worker(sizes: List[str], engine_name: str) -> None:
+    """Pool initializer, every worker gets its own factories instead of inheriting them."""
+    global engine, factories
+    engine = engine_name
+    if engine == "gnome":
+        factories = {size: GnomeDesktop.DesktopThumbnailFactory.new(thumbnail_size_map[size]) for size in sort_sizes(sizes)}
+    else:
+        factories = {size: None for size in sort_sizes(sizes)}
+
+
+def scale_down(pixbuf, size: str):
+    max_pixels = thumbnail_pixels[size]
+    width, height = pixbuf.get_width(), pixbuf.get_height()
+    if width <= max_pixels and height <= max_pixels:
+        return pixbuf
+    scale = max_pixels / max(width, height)
+    scaled = pixbuf.scale_simple(max(1, round(width * scale)), max(1, round(height * scale)), GdkPixbuf.InterpType.BILINEAR)
+    # Keeps the original image dimensions the factory records as Thumb::Image::* metadata
+    pixbuf.copy_options(scaled)
+    return scaled
+
+
+def new_stats() -> Dict[str, float]:
+    """Per file timings and I/O, filled in by the make_*thumbnail functions."""
+    return {"decode_ms": 0.0, "encode_ms": 0.0, "bytes_read": 0, "bytes_written": 0}
+
+
+def elapsed_ms(start: float) -> float:
+    return round((time.perf_counter() - start) * 1000, 2)
+
+
+def make_thumbnail(fpath: str, stats: Dict[str, float]) -> str:
+    if engine == "pillow":
+        return make_thumbnail_pillow(fpath, stats)
     mtime = os.path.getmtime(fpath)
     # Use Gio to determine the URI and mime type
     f = Gio.file_new_for_path(str(fpath))
     uri = f.get_uri()
-    info = f.query_info("standard::content-type", Gio.FileQueryInfoFlags.NONE, None)
-    mime_type = info.get_content_type()
 
-    if factory.lookup(uri, mtime) is not None:
+    stale_sizes = [size for size, factory in factories.items() if factory.lookup(uri, mtime) is None]
+    if not stale_sizes:
         logger.debug("FRESH       {}".format(uri))
-        return False
+        return "FRESH"
 
-    if not factory.can_thumbnail(uri, mime_type, mtime):
+    # The file is decoded once, at the largest size that's missing. Every smaller
+    # size is scaled down from the one before it, which is cheap at these sizes
+    largest_factory = factories[stale_sizes[0]]
+    mime_type = guess_mime_type(fpath, f)
+    if not largest_factory.can_thumbnail(uri, mime_type, mtime):
         logger.debug("UNSUPPORTED {}".format(uri))
-        return False
+        return "UNSUPPORTED"
 
-    thumbnail = factory.generate_thumbnail(uri, mime_type)
+    start = time.perf_counter()
+    thumbnail = largest_factory.generate_thumbnail(uri, mime_type)
+    stats["decode_ms"] = elapsed_ms(start)
+    stats["bytes_read"] = os.path.getsize(fpath)
     if thumbnail is None:
         logger.debug("ERROR       {}".format(uri))
+        return "ERROR"
+
+    logger.debug("OK          {}".format(uri))
+    start = time.perf_counter()
+    for size in stale_sizes:
+        thumbnail = scale_down(thumbnail, size)
+        factories[size].save_thumbnail(thumbnail, uri, mtime)
+        stats["bytes_written"] += os.path.getsize(thumbnail_path(fpath, size))
+    stats["encode_ms"] = elapsed_ms(start)
+    return "OK"
+
+
+def pillow_thumbnail_is_fresh(path: str, uri: str, mtime: int) -> bool:
+    try:
+        # PngImageFile.text would decompress the whole image to find trailing chunks,
+        # ours are in front of the image data
+        text = read_png_text(path)
+    except OSError:
         return False
+    return text.get("Thumb::URI") == uri and text.get("Thumb::MTime") == str(mtime)
+
+
+def pillow_decode(fpath: str, max_pixels: int):
+    """
+    Opens an image at close to the size it'll be thumbnailed to: JPEGs are decoded
+    at 1/2, 1/4 or 1/8 scale right away, everything else is shrunk with Image.reduce()
+    (plain box averaging) to within 2x of the target before the real resampling.
+    """
+    image = Image.open(fpath)
+    original_size = image.size
+    image.draft("RGB", (max_pixels, max_pixels))
+    image = ImageOps.exif_transpose(image)
+    if image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA" if image.has_transparency_data else "RGB")
+    factor = max(image.width, image.height) // max_pixels // 2
+    if factor > 1:
+        image = image.reduce(factor)
+    image.load()
+    return image, original_size
+
+
+def pillow_save_thumbnail(image, fpath: str, size: str, *, uri: str, mtime: int, original_size: Tuple[int, int], mime_type: Optional[str], stats: Optional[Dict[str, float]] = None):
+    """
+    Writes a spec compliant thumbnail, atomically, with the Thumb::* keys as PNG tEXt
+    chunks. Returns the scaled image so smaller sizes can continue from it.
+    """
+    max_pixels = thumbnail_pixels[size]
+    if image.width > max_pixels or image.height > max_pixels:
+        scale = max_pixels / max(image.width, image.height)
+        image = image.resize((max(1, round(image.width * scale)), max(1, round(image.height * scale))), Image.Resampling.LANCZOS)
+    info = PngImagePlugin.PngInfo()
+    info.add_text("Thumb::URI", uri)
+    info.add_text("Thumb::MTime", str(mtime))
+    info.add_text("Thumb::Size", str(os.path.getsize(fpath)))
+    info.add_text("Thumb::Image::Width", str(original_size[0]))
+    info.add_text("Thumb::Image::Height", str(original_size[1]))
+    if mime_type is not None:
+        info.add_text("Thumb::Mimetype", mime_type)
+    info.add_text("Software", "thumbgen.py")
+    path = thumbnail_path(fpath, size)
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    temp_path = "{}.{}.tmp".format(path, os.getpid())
+    try:
+        image.save(temp_path, "PNG", pnginfo=info, compress_level=3)
+        if stats is not None:
+            stats["bytes_written"] += os.path.getsize(temp_path)
+        os.chmod(temp_path, 0o600)
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return image
+
+
+def make_thumbnail_pillow(fpath: str, stats: Dict[str, float]) -> str:
+    mtime = int(os.path.getmtime(fpath))
+    uri = file_uri(fpath)
+    stale_sizes = [size for size in factories if not pillow_thumbnail_is_fresh(thumbnail_path(fpath, size), uri, mtime)]
+    if not stale_sizes:
+        logger.debug("FRESH       {}".format(uri))
+        return "FRESH"
+
+    start = time.perf_counter()
+    try:
+        image, original_size = pillow_decode(fpath, thumbnail_pixels[stale_sizes[0]])
+    except UnidentifiedImageError:
+        logger.debug("UNSUPPORTED {}".format(uri))
+        return "UNSUPPORTED"
+    except (OSError, SyntaxError, ValueError, Image.DecompressionBombError):
+        logger.debug("ERROR       {}".format(uri))
+        return "ERROR"
+
+    finally:
+        stats["decode_ms"] = elapsed_ms(start)
+        stats["bytes_read"] = os.path.getsize(fpath)
 
     logger.debug("OK          {}".format(uri))
-    factory.save_thumbnail(thumbnail, uri, mtime)
-    return True
+    mime_type, _ = mimetypes.guess_type(fpath, strict=False)
+    start = time.perf_counter()
+    # Largest first, every size is scaled down from the previous one
+    for size in stale_sizes:
+        image = pillow_save_thumbnail(image, fpath, size, uri=uri, mtime=mtime, original_size=original_size, mime_type=mime_type, stats=stats)
+    stats["encode_ms"] = elapsed_ms(start)
+    return "OK"
 
 
-@logger.catch()
-def thumbnail_folder(*, dir_path: Path, workers: int, only_images: bool, recursive: bool, machine_progress: bool = False) -> None:
-    all_files = get_all_files(dir_path=dir_path, recursive=recursive)
-    if only_images:
-        all_files = get_all_images(all_files=all_files)
-    all_files = [str(fpath) for fpath in all_files]
+def video_frame_path(fpath: str) -> str:
+    return os.path.join(VIDEO_FRAMES_DIR, hashlib.md5(os.fsencode(os.path.realpath(fpath))).hexdigest() + ".jpg")
+
+
+def video_duration(fpath: str) -> Optional[float]:
+    try:
+        result = subprocess.run(
+            ["ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "default=noprint_wrappers=1:nokey=1", fpath],
+            capture_output=True, text=True, timeout=VIDEO_TIMEOUT_SECONDS,
+        )
+        return float(result.stdout.strip())
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def extract_video_frame(fpath: str, stats: Optional[Dict[str, float]] = None):
+    """
+    Decodes a single frame at VIDEO_FRAME_POSITION. ffmpeg seeks straight to the
+    keyframe before that point and skips every non-key frame, and the frame comes
+    back as PPM through a pipe, so nothing but that one keyframe gets decoded.
+    """
+    duration = video_duration(fpath)
+    positions = [duration * VIDEO_FRAME_POSITION, 0] if duration else [0]
+    for position in positions:
+        frame = subprocess.run(
+            ["ffmpeg", "-v", "error", "-nostdin", "-skip_frame", "nokey", "-noaccurate_seek", "-ss", "{:.3f}".format(position),
+             "-i", fpath, "-map", "0:v:0", "-frames:v", "1", "-f", "image2pipe", "-c:v", "ppm", "pipe:1"],
+            capture_output=True, timeout=VIDEO_TIMEOUT_SECONDS,
+        ).stdout
+        if stats is not None:
+            stats["bytes_read"] += len(frame)
+        if frame:
+            image = Image.open(io.BytesIO(frame))
+            image.load()
+            return image
+    return None
+
+
+def cached_video_frame(fpath: str, stats: Optional[Dict[str, float]] = None):
+    """The video's frame, from the frame cache if it's newer than the video, otherwise extracted and cached."""
+    frame_path = video_frame_path(fpath)
+    try:
+        if os.path.getmtime(frame_path) >= os.path.getmtime(fpath):
+            image = Image.open(frame_path)
+            image.load()
+            if stats is not None:
+                stats["bytes_read"] += os.path.getsize(frame_path)
+            return image, frame_path
+    except OSError:
+        pass
+    image = extract_video_frame(fpath, stats)
+    if image is None:
+        return None, frame_path
+    os.makedirs(VIDEO_FRAMES_DIR, exist_ok=True)
+    temp_path = "{}.{}.{}.tmp".format(frame_path, os.getpid(), threading.get_ident())
+    try:
+        # The name can't be traced back to the video, the comment is for collect_garbage
+        image.convert("RGB").save(temp_path, "JPEG", quality=90, comment=os.fsencode(os.path.realpath(fpath)))
+        if stats is not None:
+            stats["bytes_written"] += os.path.getsize(temp_path)
+        os.replace(temp_path, frame_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return image, frame_path
+
+
+def make_video_thumbnail(fpath: str, sizes: List[str], stats: Dict[str, float]) -> str:
+    mtime = int(os.path.getmtime(fpath))
+    uri = file_uri(fpath)
+    frame_path = video_frame_path(fpath)
+    stale_sizes = [size for size in sort_sizes(sizes) if not pillow_thumbnail_is_fresh(thumbnail_path(fpath, size), uri, mtime)]
+    if not stale_sizes and os.path.exists(frame_path) and os.path.getmtime(frame_path) >= mtime:
+        logger.debug("FRESH       {}".format(uri))
+        return "FRESH"
+
+    start = time.perf_counter()
+    image, _ = cached_video_frame(fpath, stats)
+    stats["decode_ms"] = elapsed_ms(start)
+    if image is None:
+        logger.debug("ERROR       {}".format(uri))
+        return "ERROR"
+
+    logger.debug("OK          {}".format(uri))
+    mime_type, _ = mimetypes.guess_type(fpath, strict=False)
+    original_size = image.size
+    if image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGB")
+    start = time.perf_counter()
+    factor = max(image.width, image.height) // thumbnail_pixels[stale_sizes[0]] // 2 if stale_sizes else 1
+    if factor > 1:
+        image = image.reduce(factor)
+    for size in stale_sizes:
+        image = pillow_save_thumbnail(image, fpath, size, uri=uri, mtime=mtime, original_size=original_size, mime_type=mime_type, stats=stats)
+    stats["encode_ms"] = elapsed_ms(start)
+    return "OK"
+
+
+class ThumbnailIndex:
+    """
+    Stat data of every file handled for a set of thumbnail sizes, stored in the XDG
+    cache. A file whose size, mtime and inode still match its entry is skipped
+    without touching Gio or the thumbnail factory.
+    """
+
+    def __init__(self, sizes: List[str], engine: str = "gnome", path: str = INDEX_PATH):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.sizes = sort_sizes(sizes)
+        self.size = ",".join(self.sizes)
+        if engine != "gnome":
+            # Engines don't agree on what they support
+            self.size += ":" + engine
+        self.engine_version = Image.__version__ if engine == "pillow" else ""
+        self.db = sqlite3.connect(path, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS files (
+                size_name TEXT NOT NULL, dir TEXT NOT NULL, name TEXT NOT NULL,
+                file_size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, inode INTEGER NOT NULL,
+                state TEXT NOT NULL, recorded INTEGER NOT NULL DEFAULT 0, engine_version TEXT NOT NULL DEFAULT '',
+                PRIMARY KEY (size_name, dir, name)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS dirs (
+                size_name TEXT NOT NULL, path TEXT NOT NULL, mtime_ns INTEGER NOT NULL,
+                PRIMARY KEY (size_name, path)
+            ) WITHOUT ROWID;
+        """)
+        columns = {row[1] for row in self.db.execute("PRAGMA table_info(files)")}
+        if "recorded" not in columns:
+            # An index from before failures were retried, they all get another go
+            self.db.execute("ALTER TABLE files ADD COLUMN recorded INTEGER NOT NULL DEFAULT 0")
+            self.db.execute("ALTER TABLE files ADD COLUMN engine_version TEXT NOT NULL DEFAULT ''")
+        self.retry_failures_before = int(time.time()) - INDEX_FAILURE_RETRY_SECONDS
+        # Thumbnails can only have disappeared behind our back if their directory changed
+        self.thumbnail_dirs = [os.path.join(XDG_CACHE_HOME, "thumbnails", size) for size in self.sizes]
+        self.verify_thumbnails = any(self._stored_dir_mtime(d) != self._mtime_ns(d) for d in self.thumbnail_dirs)
+        self.others_removed_thumbnails = False
+
+    @staticmethod
+    def _mtime_ns(path: str) -> int:
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return -1
+
+    def _stored_dir_mtime(self, path: str) -> Optional[int]:
+        row = self.db.execute("SELECT mtime_ns FROM dirs WHERE size_name = ? AND path = ?", (self.size, path)).fetchone()
+        return row[0] if row else None
+
+    def dir_entries(self, dir_path: str) -> Dict[str, tuple]:
+        rows = self.db.execute(
+            "SELECT name, file_size, mtime_ns, inode, state, recorded, engine_version FROM files WHERE size_name = ? AND dir = ?",
+            (self.size, dir_path),
+        )
+        return {row[0]: row[1:] for row in rows}
+
+    def is_fresh(self, fpath: str, st: os.stat_result, entry: Optional[tuple]) -> bool:
+        if entry is None:
+            return False
+        file_size, mtime_ns, inode, state, recorded, engine_version = entry
+        if (file_size, mtime_ns, inode) != (st.st_size, st.st_mtime_ns, st.st_ino):
+            return False
+        if state != "OK":
+            return recorded > self.retry_failures_before and engine_version == self.engine_version
+        if self.verify_thumbnails:
+            return all(os.path.exists(thumbnail_path(fpath, size)) for size in self.sizes)
+        return True
+
+    def scan(self, dir_path: str, recursive: bool) -> Iterator[Tuple[str, os.stat_result, bool]]:
+        """Yields (path, stat, fresh) for every file, using only os.scandir() stat data."""
+        try:
+            dir_mtime = os.stat(dir_path).st_mtime_ns
+            with os.scandir(dir_path) as it:
+                dir_entries = list(it)
+        except OSError as e:
+            logger.warning("Cannot scan {}: {}".format(dir_path, e))
+            return
+        entries = self.dir_entries(dir_path)
+        seen = set()
+        for dir_entry in dir_entries:
+            try:
+                if dir_entry.is_dir():
+                    if recursive:
+                        yield from self.scan(dir_entry.path, recursive)
+                    continue
+                if not dir_entry.is_file():
+                    continue
+                st = dir_entry.stat()
+            except OSError:
+                continue
+            seen.add(dir_entry.name)
+            yield dir_entry.path, st, self.is_fresh(dir_entry.path, st, entries.get(dir_entry.name))
+        # Entries can only have been removed if the directory itself changed
+        if self._stored_dir_mtime(dir_path) != dir_mtime:
+            gone = [(self.size, dir_path, name) for name in entries.keys() - seen]
+            self.db.executemany("DELETE FROM files WHERE size_name = ? AND dir = ? AND name = ?", gone)
+            self.db.execute("INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)", (self.size, dir_path, dir_mtime))
+
+    def record(self, fpath: str, state: str) -> None:
+        try:
+            st = os.stat(fpath)
+        except OSError:
+            return
+        if state == "FRESH":
+            state = "OK"
+        dir_path, name = os.path.split(os.path.abspath(fpath))
+        self.db.execute(
+            "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (self.size, dir_path, name, st.st_size, st.st_mtime_ns, st.st_ino, state, int(time.time()), self.engine_version),
+        )
+
+    def thumbnails_removed(self) -> None:
+        """Called (from any thread) before thumbnails are removed behind the index's back."""
+        self.others_removed_thumbnails = True
+        self.verify_thumbnails = True
+
+    def commit(self) -> None:
+        # We've just written thumbnails ourselves, so start from the current state next
+        # time, unless some were removed since and the old stamps have to stay to say so
+        if not self.others_removed_thumbnails:
+            for thumbnail_dir in self.thumbnail_dirs:
+                self.db.execute("INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)", (self.size, thumbnail_dir, self._mtime_ns(thumbnail_dir)))
+        self.db.commit()
+
+    def close(self) -> None:
+        self.commit()
+        self.db.close()
+
+
+def make_thumbnails(chunk: List[str], sizes: Optional[List[str]] = None) -> List[Tuple[str, str, Dict[str, float]]]:
+    """Thumbnails a chunk of images in a pool worker, or of videos if sizes is given."""
+    results = []
+    for fpath in chunk:
+        stats = new_stats()
+        try:
+            if sizes is not None:
+                results.append((fpath, make_video_thumbnail(fpath, sizes, stats), stats))
+            else:
+                results.append((fpath, make_thumbnail(fpath, stats), stats))
+        except subprocess.TimeoutExpired:
+            logger.debug("ERROR       {} (timed out)".format(fpath))
+            results.append((fpath, "ERROR", stats))
+        except Exception:
+            # Don't let one broken file take the rest of its chunk down with it
+            logger.exception("ERROR       {}".format(fpath))
+            results.append((fpath, "ERROR", stats))
+    return results
+
+
+def available_cpus() -> int:
+    """CPUs we may actually use: the affinity mask, limited by a cgroup v2 cpu.max quota."""
+    try:
+        count = len(os.sched_getaffinity(0))
+    except AttributeError:
+        count = os.cpu_count() or 1
+    try:
+        with open("/proc/self/cgroup") as f:
+            cgroup = next(line.split(":", 2)[2].strip() for line in f if line.startswith("0::"))
+    except (OSError, StopIteration):
+        return count
+    cgroup_dir = Path("/sys/fs/cgroup") / cgroup.lstrip("/")
+    # Any ancestor can limit us, the tightest quota wins
+    for cgroup_dir in [cgroup_dir, *cgroup_dir.parents]:
+        try:
+            quota, period = (cgroup_dir / "cpu.max").read_text().split()
+        except (OSError, ValueError):
+            continue
+        if quota != "max":
+            count = min(count, math.ceil(int(quota) / int(period)))
+        if cgroup_dir == Path("/sys/fs/cgroup"):
+            break
+    return max(1, count)
+
+
+class WorkQueue:
+    """
+    Files still waiting for a worker. Prioritized files (what the wallpaper picker
+    currently shows) are handed out first, one per chunk so they spread over all
+    workers. The rest goes largest first, each chunk holding about the same amount
+    of bytes: a huge file ends up alone in its chunk instead of stalling a worker's
+    share of small ones, and starting with the expensive ones keeps the tail short.
+    """
+
+    def __init__(self, all_files: List[str], workers: int, priorities: List[str], max_chunk_files: int = MAX_CHUNK_FILES):
+        self.lock = threading.Lock()
+        self.max_chunk_files = max_chunk_files
+        self.costs = {}
+        for fpath in all_files:
+            try:
+                self.costs[fpath] = os.path.getsize(fpath) + CHUNK_FILE_OVERHEAD
+            except OSError:
+                self.costs[fpath] = CHUNK_FILE_OVERHEAD
+        self.budget = min(sum(self.costs.values()) / (workers * CHUNKS_PER_WORKER), MAX_CHUNK_BYTES)
+        self.pending = set(all_files)
+        self.by_cost = sorted(all_files, key=self.costs.get, reverse=True)
+        self.position = 0
+        self.by_abspath = {os.path.abspath(fpath): fpath for fpath in all_files}
+        self.set_priorities(priorities)
+
+    def __len__(self) -> int:
+        return len(self.pending)
+
+    def set_priorities(self, priorities: List[str]) -> None:
+        with self.lock:
+            prioritized = [self.by_abspath.get(os.path.abspath(fpath)) for fpath in priorities]
+            # Reversed, so that the most important file can be pop()ed off the end
+            self.prioritized = [fpath for fpath in reversed(prioritized) if fpath in self.pending]
+
+    def pop_chunk(self) -> List[str]:
+        with self.lock:
+            while self.prioritized:
+                fpath = self.prioritized.pop()
+                if fpath in self.pending:
+                    self.pending.remove(fpath)
+                    return [fpath]
+            chunk = []
+            chunk_cost = 0
+            while self.position < len(self.by_cost):
+                fpath = self.by_cost[self.position]
+                if fpath in self.pending:
+                    if chunk and (chunk_cost + self.costs[fpath] > self.budget or len(chunk) >= self.max_chunk_files):
+                        break
+                    self.pending.remove(fpath)
+                    chunk.append(fpath)
+                    chunk_cost += self.costs[fpath]
+                self.position += 1
+            return chunk
+
+
+def read_priority_lists(stream) -> Iterator[List[str]]:
+    """Paths one per line, a blank line or the end of the stream finishes a list."""
+    paths = []
+    for line in stream:
+        line = line.rstrip("\n")
+        if line:
+            paths.append(line)
+            continue
+        yield paths
+        paths = []
+    if paths:
+        yield paths
+
+
+class Priorities:
+    """The latest priority list, forwarded to whatever WorkQueues are active."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.paths = []
+        self.work_queues = []
+
+    def update(self, paths: List[str]) -> None:
+        with self.lock:
+            self.paths = paths
+            for work_queue in self.work_queues:
+                work_queue.set_priorities(paths)
+
+    def follow(self, stream) -> None:
+        """Keeps taking new lists from a stream, meant to run in a thread."""
+        for paths in read_priority_lists(stream):
+            logger.debug("Priorities updated: {} files".format(len(paths)))
+            self.update(paths)
+
+    def create_queue(self, all_files: List[str], workers: int, max_chunk_files: int = MAX_CHUNK_FILES) -> WorkQueue:
+        with self.lock:
+            # Queues from earlier batches that are done don't need updates anymore
+            self.work_queues = [work_queue for work_queue in self.work_queues if work_queue]
+            work_queue = WorkQueue(all_files, workers, self.paths, max_chunk_files)
+            self.work_queues.append(work_queue)
+            return work_queue
+
+
+def create_pool(*, workers: int, sizes: List[str], engine: str) -> Pool:
+    return Pool(processes=workers, initializer=init_worker, initargs=(sizes, engine))
+
+
+def can_thumbnail_videos() -> bool:
+    return Image is not None and shutil.which("ffmpeg") is not None
+
+
+def print_progress_event(event: str, **fields) -> None:
+    """
+    One --machine_progress event, as a line of JSON. Every event has "v" (the
+    PROGRESS_VERSION) and "event", one of:
+
+    - start: total, workers, video_workers, sizes
+    - file: path, status (OK, FRESH, UNSUPPORTED or ERROR), decode_ms, encode_ms,
+      bytes_read, bytes_written, completed, total, files_per_sec, eta_s
+    - done: completed, elapsed_s, files_per_sec
+    - idle: watch mode handled everything and waits for changes
+    """
+    print(json.dumps({"v": PROGRESS_VERSION, "event": event, **fields}, ensure_ascii=False))
+
+
+def thumbnail_files(*, pool: Pool, workers: int, sizes: List[str], all_files: List[str], machine_progress: bool = False, index: Optional[ThumbnailIndex] = None, priorities: Optional[Priorities] = None, video_workers: int = 2) -> None:
+    completed = 0
+    total = len(all_files)
+    start = time.monotonic()
+    progress = None if machine_progress else tqdm(total=total)
+    # (is_video, results or exception), so each kind frees up its own slot
+    finished = queue.SimpleQueue()
+    images_in_flight = 0
+    videos_in_flight = 0
+    priorities = priorities or Priorities()
+    # Videos get their own, smaller limit: each one is an ffmpeg process doing the
+    # actual work, so they're run from threads here and don't take image workers away
+    videos = [fpath for fpath in all_files if is_video(fpath)] if can_thumbnail_videos() else []
+    video_workers = min(video_workers, len(videos))
+    video_pool = ThreadPool(video_workers) if videos else None
+    if videos:
+        video_set = set(videos)
+        all_files = [fpath for fpath in all_files if fpath not in video_set]
+    # One video per chunk, prioritized ones first like images
+    video_queue = priorities.create_queue(videos, max(video_workers, 1), max_chunk_files=1)
+    work_queue = priorities.create_queue(all_files, workers)
     if machine_progress:
-        completed = 0
-        total = len(all_files)
-        with Pool(processes=workers) as p:
-            for result in p.imap(make_thumbnail, all_files):
-                completed += 1
-                print(f"PROGRESS {completed}/{total} FILE {all_files[completed-1]}")
-                sys.stdout.flush()
-    else:
-        with Pool(processes=workers) as p:
-            list(tqdm(p.imap(make_thumbnail, all_files), total=len(all_files)))
+        print_progress_event("start", total=total, workers=workers, video_workers=video_workers, sizes=sizes)
+        sys.stdout.flush()
+    # Chunks are handed out a few at a time instead of all at once like imap would,
+    # so that a priority update still affects everything that hasn't been started
+    while work_queue or video_queue or images_in_flight or videos_in_flight:
+        while work_queue and images_in_flight < workers * CHUNKS_IN_FLIGHT_PER_WORKER:
+            pool.apply_async(
+                make_thumbnails, (work_queue.pop_chunk(),),
+                callback=lambda results: finished.put((False, results)), error_callback=lambda e: finished.put((False, e)),
+            )
+            images_in_flight += 1
+        while video_queue and videos_in_flight < video_workers:
+            video_pool.apply_async(
+                make_thumbnails, (video_queue.pop_chunk(), sizes),
+                callback=lambda results: finished.put((True, results)), error_callback=lambda e: finished.put((True, e)),
+            )
+            videos_in_flight += 1
+        was_video, results = finished.get()
+        if was_video:
+            videos_in_flight -= 1
+        else:
+            images_in_flight -= 1
+        if isinstance(results, BaseException):
+            raise results
+        for fpath, result, stats in results:
+            completed += 1
+            if index is not None:
+                index.record(fpath, result)
+            if machine_progress:
+                files_per_sec = completed / max(time.monotonic() - start, 1e-6)
+                print_progress_event(
+                    "file", path=fpath, status=result, **stats, completed=completed, total=total,
+                    files_per_sec=round(files_per_sec, 2), eta_s=round((total - completed) / files_per_sec, 2),
+                )
+        if machine_progress:
+            sys.stdout.flush()
+        else:
+            progress.update(len(results))
+    if video_pool is not None:
+        video_pool.close()
+    if machine_progress:
+        elapsed = time.monotonic() - start
+        print_progress_event("done", completed=completed, elapsed_s=round(elapsed, 3), files_per_sec=round(completed / max(elapsed, 1e-6), 2))
+        sys.stdout.flush()
+    if progress is not None:
+        progress.close()
+    if index is not None:
+        index.commit()
+
+
+def collect_folder_files(*, dir_path: Path, only_images: bool, recursive: bool, index: Optional[ThumbnailIndex] = None) -> List[str]:
+    if index is None:
+        all_files = get_all_files(dir_path=dir_path, recursive=recursive)
+        if only_images:
+            all_files = get_all_images(all_files=all_files)
+        return [str(fpath) for fpath in all_files]
+
+    if not (dir_path.exists() and dir_path.is_dir()):
+        raise ValueError("{} doesn't exist or isn't a valid directory!".format(dir_path.resolve()))
+    found = 0
+    all_files = []
+    for fpath, st, fresh in index.scan(os.path.abspath(dir_path), recursive):
+        if only_images and not is_image(fpath):
+            continue
+        found += 1
+        if not fresh:
+            all_files.append(fpath)
+    index.commit()
+    print("Found {} files in the directory: {} ({} changed)".format(found, dir_path.resolve(), len(all_files)))
+    return all_files
+
+
+@logger.catch()
+def thumbnail_folder(*, dir_path: Path, sizes: List[str], engine: str, workers: int, only_images: bool, recursive: bool, machine_progress: bool = False, index: Optional[ThumbnailIndex] = None, priorities: Optional[Priorities] = None, video_workers: int = 2) -> None:
+    all_files = collect_folder_files(dir_path=dir_path, only_images=only_images, recursive=recursive, index=index)
+    if not all_files:
+        return
+    # No point in starting (and initializing factories for) more workers than files
+    workers = min(workers, len(all_files))
+    with create_pool(workers=workers, sizes=sizes, engine=engine) as p:
+        thumbnail_files(pool=p, workers=workers, sizes=sizes, video_workers=video_workers, all_files=all_files, machine_progress=machine_progress, index=index, priorities=priorities)
+
+
+def read_png_text(path: str) -> Dict[str, str]:
+    """
+    Reads the tEXt chunks in front of a PNG's image data and seeks past everything
+    else, so going through a big cache never touches (or decompresses) pixel data.
+    """
+    text = {}
+    with open(path, "rb") as f:
+        if f.read(8) != PNG_SIGNATURE:
+            return text
+        while f.tell() < PNG_HEADER_READ_LIMIT:
+            header = f.read(8)
+            if len(header) < 8:
+                break
+            length, chunk_type = struct.unpack(">I4s", header)
+            if chunk_type in (b"IDAT", b"IEND"):
+                break
+            if chunk_type == b"tEXt":
+                key, _, value = f.read(length).partition(b"\0")
+                text[key.decode("latin-1")] = value.decode("latin-1")
+                f.seek(4, os.SEEK_CUR)
+            else:
+                f.seek(length + 4, os.SEEK_CUR)
+    return text
+
+
+def parse_byte_size(text: str) -> int:
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+    text = text.strip().upper().rstrip("IB")
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def parse_gc_budgets(spec: str) -> Dict[str, int]:
+    """Parses '256M' (the same budget for every size) or 'normal=64M,large=256M'."""
+    budgets = {}
+    for part in spec.split(","):
+        if not part:
+            continue
+        size, sep, amount = part.rpartition("=")
+        for name in (thumbnail_pixels if not sep else [size]):
+            if name not in thumbnail_pixels:
+                raise ValueError("Invalid size '{}'".format(name))
+            budgets[name] = parse_byte_size(amount)
+    return budgets
+
+
+def is_gone_for_good(source: str, source_dirs: Optional[List[str]]) -> bool:
+    """
+    Whether a missing source really is gone. The thumbnail cache is shared with every
+    other app, so only sources under source_dirs count, if given, and never ones whose
+    directory is missing too: that's an unmounted drive as often as a deleted folder.
+    """
+    if source_dirs is not None and not any(source.startswith(os.path.join(d, "")) for d in source_dirs):
+        return False
+    return os.path.isdir(os.path.dirname(source))
+
+
+def stale_thumbnail_reason(path: str, source_mtimes: Dict[str, Optional[int]], source_dirs: Optional[List[str]] = None) -> Optional[str]:
+    """Says why a thumbnail should go, or None if it's still good (or not ours to judge)."""
+    try:
+        text = read_png_text(path)
+    except OSError:
+        return None
+    uri = text.get("Thumb::URI")
+    if uri is None or not uri.startswith("file://"):
+        # Not a file we can check, leave it to whoever made it
+        return None
+    source = os.fsdecode(urllib.parse.unquote_to_bytes(uri[len("file://"):]))
+    if source not in source_mtimes:
+        try:
+            source_mtimes[source] = int(os.stat(source).st_mtime)
+        except OSError:
+            source_mtimes[source] = None
+    if source_mtimes[source] is None:
+        return "orphan" if is_gone_for_good(source, source_dirs) else None
+    if text.get("Thumb::MTime") != str(source_mtimes[source]):
+        return "outdated"
+    return None
+
+
+def stale_video_frame_reason(path: str, frame_mtime: float) -> Optional[str]:
+    """Says why a cached video frame should go, or None if it's still good."""
+    try:
+        # Only reads the markers in front of the image data, the comment is one of them
+        with Image.open(path) as frame:
+            comment = frame.info.get("comment")
+    except (OSError, SyntaxError, ValueError):
+        return "orphan"
+    if not comment:
+        # From before frames said where they came from, extracted again when needed
+        return "orphan"
+    try:
+        source_mtime = os.stat(os.fsdecode(comment)).st_mtime
+    except OSError:
+        return "orphan"
+    # cached_video_frame only uses frames written after the video changed
+    if frame_mtime < source_mtime:
+        return "outdated"
+    return None
+
+
+def collect_garbage(*, budgets: Optional[Dict[str, int]] = None, source_dirs: Optional[List[Path]] = None) -> Dict[str, int]:
+    """
+    Removes thumbnails whose source is gone (see is_gone_for_good()) or has changed
+    since, then evicts the least recently used ones from each size that is still over
+    its byte budget. Cached video frames go when their video is gone or has changed
+    since too.
+    """
+    budgets = budgets or {}
+    if source_dirs is not None:
+        source_dirs = [os.path.abspath(d) for d in source_dirs]
+    counts = {"orphan": 0, "outdated": 0, "evicted": 0, "temporary": 0, "freed": 0}
+    # Shared between sizes, most sources have a thumbnail in several of them
+    source_mtimes = {}
+    now = time.time()
+    for size in thumbnail_pixels:
+        size_dir = os.path.join(XDG_CACHE_HOME, "thumbnails", size)
+        kept = []
+        try:
+            entries = list(os.scandir(size_dir))
+        except FileNotFoundError:
+            continue
+        for entry in entries:
+            try:
+                st = entry.stat()
+            except FileNotFoundError:
+                continue
+            if entry.name.endswith(".tmp"):
+                reason = "temporary" if now - st.st_mtime > GC_TEMP_FILE_AGE_SECONDS else None
+            elif entry.name.endswith(".png"):
+                reason = stale_thumbnail_reason(entry.path, source_mtimes, source_dirs)
+            else:
+                continue
+            if reason is None:
+                if not entry.name.endswith(".tmp"):
+                    # atime is only as good as the mount options, a fresh write counts as a use too
+                    kept.append((max(st.st_atime, st.st_mtime), st.st_size, entry.path))
+                continue
+            with contextlib.suppress(OSError):
+                os.remove(entry.path)
+                counts[reason] += 1
+                counts["freed"] += st.st_size
+
+        budget = budgets.get(size)
+        if budget is None:
+            continue
+        used = sum(size_bytes for _, size_bytes, _ in kept)
+        kept.sort()
+        for _, size_bytes, path in kept:
+            if used <= budget:
+                break
+            with contextlib.suppress(OSError):
+                os.remove(path)
+                counts["evicted"] += 1
+                counts["freed"] += size_bytes
+            used -= size_bytes
+
+    try:
+        frames = list(os.scandir(VIDEO_FRAMES_DIR))
+    except FileNotFoundError:
+        frames = []
+    for entry in frames:
+        try:
+            st = entry.stat()
+        except FileNotFoundError:
+            continue
+        if entry.name.endswith(".tmp"):
+            reason = "temporary" if now - st.st_mtime > GC_TEMP_FILE_AGE_SECONDS else None
+        elif entry.name.endswith(".jpg"):
+            reason = stale_video_frame_reason(entry.path, st.st_mtime)
+        else:
+            continue
+        if reason is None:
+            continue
+        with contextlib.suppress(OSError):
+            os.remove(entry.path)
+            counts[reason] += 1
+            counts["freed"] += st.st_size
+
+    os.makedirs(os.path.dirname(GC_STAMP_PATH), exist_ok=True)
+    Path(GC_STAMP_PATH).touch()
+    logger.info("Thumbnail cache: removed {orphan} orphaned, {outdated} outdated, {evicted} least recently used and {temporary} temporary files ({freed} bytes)".format(**counts))
+    return counts
+
+
+def collect_garbage_in_background(budgets: Optional[Dict[str, int]] = None, source_dirs: Optional[List[Path]] = None, index: Optional[ThumbnailIndex] = None) -> None:
+    """Runs a pass at idle priority in a daemon thread, unless one ran recently."""
+    try:
+        if time.time() - os.path.getmtime(GC_STAMP_PATH) < GC_INTERVAL_SECONDS:
+            return
+    except OSError:
+        pass
+
+    def run():
+        # Linux niceness is per thread, this leaves the thumbnailing itself alone
+        with contextlib.suppress(OSError):
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+        if index is not None:
+            # Before removing anything, so no commit can stamp the result as our own
+            index.thumbnails_removed()
+        collect_garbage(budgets=budgets, source_dirs=source_dirs)
+
+    threading.Thread(target=logger.catch(run), daemon=True).start()
+
+
+class Inotify:
+    """Minimal ctypes binding for inotify(7), so watching needs no extra dependency."""
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, "inotify_init1: {}".format(os.strerror(errno)))
+        self.watches = {}
+
+    def add_watch(self, dir_path: Path) -> None:
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(str(dir_path)), WATCH_MASK)
+        if wd < 0:
+            logger.warning("Cannot watch {}: {}".format(dir_path, os.strerror(ctypes.get_errno())))
+            return
+        self.watches[wd] = dir_path
+
+    def read_events(self) -> List[tuple]:
+        """Returns (mask, path) pairs for everything queued on the inotify fd."""
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return events
+            offset = 0
+            while offset < len(data):
+                wd, mask, _cookie, length = struct.unpack_from("iIII", data, offset)
+                offset += struct.calcsize("iIII")
+                name = data[offset:offset + length].rstrip(b"\0")
+                offset += length
+                if mask & IN_Q_OVERFLOW:
+                    events.append((mask, None))
+                    continue
+                dir_path = self.watches.get(wd)
+                if mask & IN_IGNORED:
+                    self.watches.pop(wd, None)
+                    continue
+                if dir_path is None:
+                    continue
+                events.append((mask, dir_path / os.fsdecode(name) if name else dir_path))
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+def watch_directories(inotify: Inotify, dir_path: Path, recursive: bool) -> None:
+    inotify.add_watch(dir_path)
+    if recursive:
+        for sub_dir in dir_path.rglob("*"):
+            if sub_dir.is_dir():
+                inotify.add_watch(sub_dir)
+
+
+def changed_files(*, inotify: Inotify, events: Iterable[tuple], only_images: bool, recursive: bool) -> Set[str]:
+    files = set()
+    for mask, fpath in events:
+        if mask & IN_ISDIR:
+            # A directory was created or moved into a watched one
+            if recursive and mask & (IN_CREATE | IN_MOVED_TO) and fpath.is_dir():
+                watch_directories(inotify, fpath, recursive)
+                files.update(str(p) for p in fpath.rglob("*") if p.is_file() and (not only_images or is_image(p)))
+            continue
+        if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+            continue
+        if mask & IN_CREATE:
+            # Wait for IN_CLOSE_WRITE, the file is most likely still being written
+            continue
+        if only_images and not is_image(fpath):
+            continue
+        files.add(str(fpath))
+    return files
+
+
+@logger.catch()
+def watch_folders(*, dir_paths: List[Path], sizes: List[str], engine: str, workers: int, only_images: bool, recursive: bool, machine_progress: bool = False, index: Optional[ThumbnailIndex] = None, priorities: Optional[Priorities] = None, video_workers: int = 2, gc_budgets: Optional[Dict[str, int]] = None) -> None:
+    """Keeps the factory and worker pool alive and only thumbnails files that changed."""
+    inotify = Inotify()
+    for dir_path in dir_paths:
+        # Changed files are reported relative to the watch, absolute like the indexed scan's
+        watch_directories(inotify, Path(os.path.abspath(dir_path)), recursive)
+    poller = select.poll()
+    poller.register(inotify.fd, select.POLLIN)
+    # Registering with no events still reports POLLERR/POLLHUP, which is how we
+    # notice that whoever reads our output went away, so we don't outlive the shell
+    stdout_fd = sys.stdout.fileno()
+    poller.register(stdout_fd, 0)
+
+    def report_idle():
+        if machine_progress:
+            print_progress_event("idle")
+            sys.stdout.flush()
+
+    with create_pool(workers=workers, sizes=sizes, engine=engine) as p:
+        for dir_path in dir_paths:
+            all_files = collect_folder_files(dir_path=dir_path, only_images=only_images, recursive=recursive, index=index)
+            thumbnail_files(pool=p, workers=workers, sizes=sizes, video_workers=video_workers, all_files=all_files, machine_progress=machine_progress, index=index, priorities=priorities)
+        report_idle()
+        if gc_budgets is not None:
+            collect_garbage_in_background(gc_budgets, dir_paths, index)
+
+        pending = set()
+        rescan = False
+        first_event_time = None
+        while True:
+            timeout = None if first_event_time is None else WATCH_DEBOUNCE_SECONDS * 1000
+            ready = poller.poll(timeout)
+            for fd, event in ready:
+                if fd == stdout_fd and event & (select.POLLERR | select.POLLHUP):
+                    logger.debug("Output closed, stopping watch")
+                    inotify.close()
+                    return
+            events = inotify.read_events() if ready else []
+            if events:
+                if any(mask & IN_Q_OVERFLOW for mask, _ in events):
+                    rescan = True
+                else:
+                    pending |= changed_files(inotify=inotify, events=events, only_images=only_images, recursive=recursive)
+                if first_event_time is None:
+                    first_event_time = time.monotonic()
+                if time.monotonic() - first_event_time < WATCH_MAX_DELAY_SECONDS:
+                    continue
+            if first_event_time is None:
+                continue
+
+            if rescan:
+                logger.debug("inotify queue overflowed, rescanning")
+                pending = set()
+                for dir_path in dir_paths:
+                    pending.update(collect_folder_files(dir_path=dir_path, only_images=only_images, recursive=recursive, index=index))
+            batch = sorted(f for f in pending if os.path.isfile(f))
+            pending = set()
+            rescan = False
+            first_event_time = None
+            if batch:
+                logger.debug("Changed: {}".format(batch))
+                thumbnail_files(pool=p, workers=workers, sizes=sizes, video_workers=video_workers, all_files=batch, machine_progress=machine_progress, index=index, priorities=priorities)
+                report_idle()
+
+
+def is_image(fpath: Union[str, Path]) -> bool:
+    return os.path.splitext(fpath)[1] in IMAGE_SUFFIXES
+
+
+def is_video(fpath: Union[str, Path]) -> bool:
+    return os.path.splitext(fpath)[1] in VIDEO_SUFFIXES
 
 
 def get_all_images(*, all_files: List[Path]) -> List[Path]:
-    img_suffixes = [".jpg", ".jpeg", ".png", ".gif"]
-    all_images = [fpath for fpath in all_files if fpath.suffix in img_suffixes]
+    all_images = [fpath for fpath in all_files if is_image(fpath)]
     print("Found {} images".format(len(all_images)))
     return all_images
 
@@ -94,11 +1189,19 @@ def get_all_files(*, dir_path: Path, recursive: bool) -> List[Path]:
 
 def main(argv):
     img_dirs = ""
-    size = "normal"
-    workers = 1
+    sizes = ["normal"]
+    engine = "gnome"
+    workers = available_cpus()
+    video_workers = 2
     only_images = False
     recursive = False
     machine_progress = False
+    watch = False
+    use_index = True
+    priority_from = None
+    priority_stdin = False
+    gc = False
+    gc_budgets = {}
 
     i = 0
     while i < len(argv):
@@ -107,11 +1210,29 @@ def main(argv):
             img_dirs = argv[i + 1]
             i += 2
         elif arg in ("-s", "--size") and i + 1 < len(argv):
-            size = argv[i + 1]
+            sizes = [argv[i + 1]]
+            i += 2
+        elif arg == "--engine" and i + 1 < len(argv):
+            engine = argv[i + 1]
+            i += 2
+        elif arg == "--sizes" and i + 1 < len(argv):
+            sizes = [size for size in argv[i + 1].split(",") if size]
             i += 2
         elif arg in ("-w", "--workers") and i + 1 < len(argv):
-            workers = int(argv[i + 1])
+            workers = max(1, int(argv[i + 1]))
             i += 2
+        elif arg == "--video_workers" and i + 1 < len(argv):
+            video_workers = max(1, int(argv[i + 1]))
+            i += 2
+        elif arg == "--video_frame" and i + 1 < len(argv):
+            # Just print the path of a video's cached frame, extracting it if needed
+            if Image is None:
+                sys.exit("Error: Pillow is not available")
+            image, frame_path = cached_video_frame(argv[i + 1])
+            if image is None:
+                sys.exit(f"Error: Could not extract a frame from '{argv[i + 1]}'")
+            print(frame_path)
+            return
         elif arg in ("-i", "--only_images"):
             only_images = True
             i += 1
@@ -121,19 +1242,68 @@ def main(argv):
         elif arg == "--machine_progress":
             machine_progress = True
             i += 1
+        elif arg == "--watch":
+            watch = True
+            i += 1
+        elif arg == "--no_index":
+            use_index = False
+            i += 1
+        elif arg == "--priority_from" and i + 1 < len(argv):
+            priority_from = argv[i + 1]
+            i += 2
+        elif arg == "--priority_stdin":
+            priority_stdin = True
+            i += 1
+        elif arg == "--gc":
+            gc = True
+            i += 1
+        elif arg == "--gc_budget" and i + 1 < len(argv):
+            try:
+                gc_budgets = parse_gc_budgets(argv[i + 1])
+            except ValueError as e:
+                sys.exit(f"Error: Invalid '--gc_budget': {e}")
+            i += 2
         else:
             i += 1
 
+    if gc and not img_dirs:
+        # Cache maintenance on its own, nothing to thumbnail
+        collect_garbage(budgets=gc_budgets)
+        return
     if not img_dirs:
         sys.exit("Error: Missing required option '-d/--img_dirs'")
-    if size not in thumbnail_size_map:
-        sys.exit(f"Error: Invalid size '{size}'. Must be one of: normal, large, x-large, xx-large")
+    for size in sizes:
+        if size not in thumbnail_pixels:
+            sys.exit(f"Error: Invalid size '{size}'. Must be one of: normal, large, x-large, xx-large")
+    if engine not in ENGINES:
+        sys.exit(f"Error: Invalid engine '{engine}'. Must be one of: {', '.join(ENGINES)}")
+    if engine == "gnome" and GnomeDesktop is None:
+        sys.exit("Error: GnomeDesktop is not available, try '--engine pillow'")
+    if engine == "pillow" and Image is None:
+        sys.exit("Error: Pillow is not available")
 
     img_dirs = [Path(img_dir) for img_dir in img_dirs.split()]
-    global factory
-    factory = GnomeDesktop.DesktopThumbnailFactory.new(thumbnail_size_map[size])
+    index = ThumbnailIndex(sizes, engine) if use_index else None
+    priorities = Priorities()
+    if priority_from is not None:
+        with open(priority_from) as f:
+            priorities.update(next(read_priority_lists(f), []))
+    if priority_stdin:
+        # A stream of our own: pool workers close sys.stdin when they start, which
+        # deadlocks if they were forked while this thread held its lock
+        priority_stream = open(sys.stdin.fileno(), closefd=False)
+        threading.Thread(target=priorities.follow, args=(priority_stream,), daemon=True).start()
+    if watch:
+        # Let the pool shut down its workers instead of orphaning them
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        watch_folders(dir_paths=img_dirs, sizes=sizes, engine=engine, workers=workers, video_workers=video_workers, only_images=only_images, recursive=recursive, machine_progress=machine_progress, index=index, priorities=priorities, gc_budgets=gc_budgets if gc else None)
+        return
     for img_dir in img_dirs:
-        thumbnail_folder(dir_path=img_dir, workers=workers, only_images=only_images, recursive=recursive, machine_progress=machine_progress)
+        thumbnail_folder(dir_path=img_dir, sizes=sizes, engine=engine, workers=workers, video_workers=video_workers, only_images=only_images, recursive=recursive, machine_progress=machine_progress, index=index, priorities=priorities)
+    if index is not None:
+        index.close()
+    if gc:
+        collect_garbage(budgets=gc_budgets, source_dirs=img_dirs)
     print("Thumbnail Generation Completed!")
 
 
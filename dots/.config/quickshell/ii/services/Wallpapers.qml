@@ -17,6 +17,8 @@ Singleton {
 
     property string thumbgenScriptPath: `${FileUtils.trimFileProtocol(Directories.scriptPath)}/thumbnails/thumbgen-venv.sh`
     property string generateThumbnailsMagickScriptPath: `${FileUtils.trimFileProtocol(Directories.scriptPath)}/thumbnails/generate-thumbnails-magick.sh`
+    property string generateColorsScriptPath: `${FileUtils.trimFileProtocol(Directories.scriptPath)}/colors/generate-colors-material-venv.sh`
+    property string paletteIndexPath: `${FileUtils.trimFileProtocol(Directories.genericCache)}/quickshell/palette-index.json`
     property alias directory: folderModel.folder
     readonly property string effectiveDirectory: FileUtils.trimFileProtocol(folderModel.folder.toString())
     property url defaultFolder: Qt.resolvedUrl(`${Directories.pictures}/Wallpapers`)
@@ -26,8 +28,11 @@ Singleton {
         "jpg", "jpeg", "png", "webp", "avif", "bmp", "svg"
     ]
     property list<string> wallpapers: [] // List of absolute file paths (without file://)
-    readonly property bool thumbnailGenerationRunning: thumbgenProc.running
+    readonly property bool thumbnailGenerationRunning: thumbgenProc.running && thumbgenProc.busy
     property real thumbnailGenerationProgress: 0
+    property real thumbnailGenerationEta: 0 // Seconds
+    // Absolute path -> { seed, hue, chroma, tone, scheme, dark: { role: color }, light: { role: color } }
+    property var paletteIndex: ({})
 
     signal changed()
     signal thumbnailGenerated(directory: string)
@@ -135,38 +140,109 @@ Singleton {
     // Thumbnail generation
     function generateThumbnail(size: string) {
         if (!["normal", "large", "x-large", "xx-large"].includes(size)) throw new Error("Invalid thumbnail size");
+        // thumbgen keeps watching the directory, so there's nothing to do if it's already on it
+        if (thumbgenProc.running && thumbgenProc.directory === root.directory.toString() && thumbgenProc.size === size) return;
         thumbgenProc.directory = root.directory
+        thumbgenProc.size = size
         thumbgenProc.running = false
         thumbgenProc.command = [
             "bash", "-c",
-            `${thumbgenScriptPath} --size ${size} --machine_progress -d ${FileUtils.trimFileProtocol(root.directory)} || ${generateThumbnailsMagickScriptPath} --size ${size} -d ${FileUtils.trimFileProtocol(root.directory)}`,
+            `${thumbgenScriptPath} --size ${size} --machine_progress --watch --priority_stdin -d ${FileUtils.trimFileProtocol(root.directory)} || ${thumbgenScriptPath} --engine pillow --size ${size} --machine_progress --watch --priority_stdin -d ${FileUtils.trimFileProtocol(root.directory)} || ${generateThumbnailsMagickScriptPath} --size ${size} -d ${FileUtils.trimFileProtocol(root.directory)}`,
         ]
         // console.log("[Wallpapers] Updating thumbnails with command ", thumbgenProc.command.join(" "))
         root.thumbnailGenerationProgress = 0
+        thumbgenProc.busy = true
         thumbgenProc.running = true
     }
+    // Palette previews, precomputed for the whole directory so looking them up is instant
+    function palettePreview(path) {
+        return root.paletteIndex[FileUtils.trimFileProtocol(path)] ?? null;
+    }
+    function sortByColor(paths) { // By hue, then grays by tone, then what isn't indexed yet
+        const rank = path => {
+            const entry = root.palettePreview(path);
+            if (!entry) return [2, 0];
+            if (entry.chroma < 12) return [1, entry.tone];
+            return [0, entry.hue];
+        };
+        return paths.map(path => [rank(path), path])
+            .sort((a, b) => a[0][0] - b[0][0] || a[0][1] - b[0][1])
+            .map(pair => pair[1]);
+    }
+    function precomputePalettes() { // Not started on its own, nothing in the picker shows the index yet
+        // Both want every core and the thumbnails are what's on screen, so this waits for thumbgen to be idle
+        paletteBatchProc.pending = true
+        if (!root.thumbnailGenerationRunning) root.startPaletteBatch()
+    }
+    function startPaletteBatch() {
+        const type = Config.options.appearance.palette.type;
+        paletteBatchProc.pending = false
+        paletteBatchProc.running = false
+        paletteBatchProc.command = ["nice", "-n", "19", root.generateColorsScriptPath, "--batch", FileUtils.trimFileProtocol(root.directory),
+            "--scheme", type.length > 0 ? type : "auto"]
+        paletteBatchProc.running = true
+    }
+    Process {
+        id: paletteBatchProc
+        property bool pending: false
+    }
+    FileView {
+        id: paletteIndexFileView
+        path: root.paletteIndexPath
+        watchChanges: true
+        onFileChanged: reload()
+        onLoaded: {
+            try {
+                const index = JSON.parse(paletteIndexFileView.text())
+                if (index.version === 1) root.paletteIndex = index.files
+            } catch (e) {
+                console.log("[Wallpapers] Could not read palette index: " + e)
+            }
+        }
+    }
+
+    function prioritizeThumbnails(paths) { // Files the user is looking at, they jump the queue
+        if (!thumbgenProc.running) return;
+        thumbgenProc.write(paths.join("\n") + "\n\n");
+    }
     Process {
         id: thumbgenProc
         property string directory
+        property string size
+        property bool busy: false
+        stdinEnabled: true
         stdout: SplitParser {
             onRead: data => {
                 // print("thumb gen proc:", data)
-                let match = data.match(/PROGRESS (\d+)\/(\d+)/)
-                if (match) {
-                    const completed = parseInt(match[1])
-                    const total = parseInt(match[2])
-                    root.thumbnailGenerationProgress = completed / total
+                if (!data.startsWith("{")) return; // Log lines
+                let event;
+                try {
+                    event = JSON.parse(data)
+                } catch (e) {
+                    return
                 }
-                match = data.match(/FILE (.+)/)
-                if (match) {
-                    const filePath = match[1]
-                    root.thumbnailGeneratedFile(filePath)
+                if (event.v !== 1) return; // Progress format we don't know
+                if (event.event === "idle") { // Watch mode finished a batch and is waiting for changes
+                    thumbgenProc.busy = false
+                    root.thumbnailGenerated(thumbgenProc.directory)
+                    if (paletteBatchProc.pending) root.startPaletteBatch()
+                } else if (event.event === "start") {
+                    thumbgenProc.busy = event.total > 0
+                    root.thumbnailGenerationProgress = 0
+                } else if (event.event === "file") {
+                    thumbgenProc.busy = true
+                    root.thumbnailGenerationProgress = event.completed / event.total
+                    root.thumbnailGenerationEta = event.eta_s
+                    if (event.status === "OK" || event.status === "FRESH")
+                        root.thumbnailGeneratedFile(event.path)
                 }
             }
         }
         onExited: (exitCode, exitStatus) => {
             // print("[Wallpapers] Thumbnail generation completed with exit code", exitCode)
+            thumbgenProc.busy = false
             root.thumbnailGenerated(thumbgenProc.directory)
+            if (paletteBatchProc.pending) root.startPaletteBatch()
         }
     }
 
@@ -176,5 +252,9 @@ Singleton {
         function apply(path: string): void {
             root.apply(path);
         }
+
+        function precomputePalettes(): void {
+            root.precomputePalettes();
+        }
     }
 }